@@ -1,12 +1,18 @@
 import os
+import threading
 import traceback
 from flask import Flask, render_template, request, make_response, \
-    redirect, url_for, send_from_directory, Response, session
+    redirect, url_for, send_from_directory, Response, session, jsonify
 import secrets
 from dotenv import load_dotenv
-from src.PDFTextToSpeech import PDFTextToSpeech
+from src import Metrics
+from src.AudioCache import get_cache
+from src.Backends import backend_class, get_backend
+from src.Export import EXPORT_FORMATS
+from src.Jobs import JobManager
+from src.SessionCache import SessionCache
+from src.Uploads import UploadRequest, store_upload
 from pathlib import Path
-import hashlib
 
 load_dotenv()
 
@@ -25,18 +31,69 @@ if 'UPLOAD_FOLDER' not in os.environ:
         'UPLOAD_FOLDER not found in environment. Please set this key in your environment, or use the .env file.')
 
 app = Flask(__name__)
+# Uploaded files are streamed to disk and hashed while the request is parsed
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 app.config['TEMPLATES_AUTO_RELOAD'] = os.environ['TEMPLATES_AUTO_RELOAD']
 app.config['UPLOAD_FOLDER'] = os.environ['UPLOAD_FOLDER']
 app.config['ALLOWED_EXTENSIONS'] = {'pdf'}
+app.config['SESSION_CACHE_MB'] = int(os.environ.get('SESSION_CACHE_MB', 256))
+app.config['SESSION_CACHE_IDLE_SECONDS'] = int(os.environ.get('SESSION_CACHE_IDLE_SECONDS', 30 * 60))
+app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', 2))
+app.config['EXTRACTION_WORKERS'] = int(os.environ.get('EXTRACTION_WORKERS', 1))
+# Largest accepted upload request, larger ones are rejected while being received
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 100)) * 1024 * 1024
+# Uploads received at the same time, further ones wait up to UPLOAD_QUEUE_SECONDS for a slot
+app.config['MAX_CONCURRENT_UPLOADS'] = int(os.environ.get('MAX_CONCURRENT_UPLOADS', 4))
+app.config['UPLOAD_QUEUE_SECONDS'] = int(os.environ.get('UPLOAD_QUEUE_SECONDS', 30))
+# Most sentences returned by one `text` request
+app.config['MAX_TEXT_WINDOW'] = 1000
 
 print("=" * 80)
 print("FLASK_DEBUG = " + os.environ['FLASK_DEBUG'])
 print("TEMPLATES_AUTO_RELOAD = " + app.config['TEMPLATES_AUTO_RELOAD'])
 print("UPLOAD_FOLDER = " + app.config['UPLOAD_FOLDER'])
 print("ALLOWED_EXTENSIONS = " + str(app.config['ALLOWED_EXTENSIONS']))
+print("MAX_CONTENT_LENGTH = " + str(app.config['MAX_CONTENT_LENGTH']))
+print("SESSION_CACHE_MB = " + str(app.config['SESSION_CACHE_MB']))
+print("PROCESSING_WORKERS = " + str(app.config['PROCESSING_WORKERS']))
+print("EXTRACTION_WORKERS = " + str(app.config['EXTRACTION_WORKERS']))
+print("TTS_CACHE_FOLDER = " + os.environ.get('TTS_CACHE_FOLDER', 'tts_cache'))
 print("=" * 80)
 
+# Live documents shared across requests, keyed by upload_id
+sessions = SessionCache(max_memory_bytes=app.config['SESSION_CACHE_MB'] * 1024 * 1024,
+                        max_idle_seconds=app.config['SESSION_CACHE_IDLE_SECONDS'])
+# Background document processing
+jobs = JobManager(max_workers=app.config['PROCESSING_WORKERS'],
+                  extraction_workers=app.config['EXTRACTION_WORKERS'])
+# Bounds the number of uploads being received, and so the disk bandwidth and open files they use
+upload_slots = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_UPLOADS'])
+
+Metrics.Gauge("pdf_tts_session_memory_bytes", "Memory used by the live documents in the session cache",
+              function=sessions.memory_usage)
+Metrics.Gauge("pdf_tts_audio_cache_bytes", "Size of the shared audio cache on disk",
+              function=lambda: get_cache().total_bytes)
+
+
+def preload():
+    # Imports the heavy dependencies (PyMuPDF, the TTS client library) ahead of the first request, e.g. once in the
+    # master process of a pre-fork server (`gunicorn --preload`). Clients are still created after the fork
+    import fitz  # noqa: F401
+    import tqdm  # noqa: F401
+    backend_class().preload()
+
+
+def warm_up():
+    # Per worker process: also creates the TTS client and reads the audio cache index before a listener needs them
+    preload()
+    get_backend()
+    get_cache().load()
+
+
+if os.environ.get('PRELOAD', '0') == '1':
+    preload()
+
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -52,6 +109,43 @@ def rrmdir(path):
     os.rmdir(path)
 
 
+def parse_index(req, p):
+    # Returns (sentence index, None) from the `index` query param, or (None, error response)
+    stream_index = req.args.get('index')
+    if not stream_index or not stream_index.isdigit():
+        return None, Response("Required integer `index` query param not specified", status=400)
+    stream_index = int(stream_index)
+    if stream_index >= (p.num_sentences() or 0):
+        return None, Response("Requested `index` is not available", status=404)
+    return stream_index, None
+
+
+def parse_text_window(req):
+    # Returns ((start, count), None) from the query params, or (None, error response)
+    start = req.args.get('start', '0')
+    count = req.args.get('count', '200')
+    if not start.isdigit() or not count.isdigit():
+        return None, Response("Integer `start` and `count` query params required", status=400)
+    return (int(start), min(int(count), app.config['MAX_TEXT_WINDOW'])), None
+
+
+def accepts_stored(req):
+    # Compressed audio is sent as stored to clients that accept it, and decoded to WAV for the others
+    return lambda mimetype: req.accept_mimetypes.best_match([mimetype, 'audio/wav']) == mimetype
+
+
+def audio_response(req, p, stream_index, audio, mimetype):
+    r = Response(audio, mimetype=mimetype)
+    # The URL names a position, whose sentence changes when the document is re-processed or cleaned: caches may keep
+    # the audio but must revalidate it, which only costs a 304 while the sentence, and so its ETag, is the same
+    etag = p.etag(stream_index)
+    r.set_etag(etag if mimetype == "audio/x-wav" else f"{etag}-{mimetype.split('/')[1]}")
+    r.vary.add('Accept')
+    r.cache_control.public = True
+    r.cache_control.no_cache = True
+    return r.make_conditional(req, accept_ranges=True, complete_length=len(audio))
+
+
 @app.before_request
 def make_session_permanent():
     session.permanent = True
@@ -65,6 +159,11 @@ def index():
     return render_template("./index.html", uploads=uploads, message="Upload a PDF file to get started.")
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(Metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/<upload_id>')
 def player(upload_id):
     upload_dir_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
@@ -94,10 +193,58 @@ def player(upload_id):
     fname_pdf = pdf_files[0]
     fname_txt = fname_pdf.replace('.pdf', '.txt')
     fname_txt_processed = fname_txt.replace('.txt', '_processed.txt')
-    p = PDFTextToSpeech(os.path.join(upload_dir_path, fname_pdf))
+    pdf_file_path = os.path.join(upload_dir_path, fname_pdf)
+    p = sessions.get(upload_id, pdf_file_path)
+
+    # Streaming only needs the live session, skip building the page data
+    if query == 'stream':
+        stream_index, error = parse_index(request, p)
+        if error is not None:
+            return error
+        audio, mimetype = p.stream_audio(stream_index, accept=accepts_stored(request))
+        return audio_response(request, p, stream_index, audio, mimetype)
+    if query == 'stream_from':
+        stream_index, error = parse_index(request, p)
+        if error is not None:
+            return error
+        r = Response(p.stream_from(stream_index), mimetype="audio/x-wav")
+        r.cache_control.no_store = True
+        return r
+    if query == 'timeline':
+        # Of the continuous stream started at `index`
+        stream_index, error = parse_index(request, p)
+        if error is not None:
+            return error
+        return jsonify(p.timeline(stream_index))
+    if query == 'status':
+        return jsonify(jobs.status(upload_id, pdf_file_path) or {'status': None})
+    if query == 'text':
+        window, error = parse_text_window(request)
+        if error is not None:
+            return error
+        return jsonify(p.get_text(*window))
+    if query == 'prepare_export':
+        # Rendering of the audio an export needs, started with `start=1` and polled until it is done
+        if p.num_sentences() is None:
+            return jsonify({'status': None})
+        if not p.missing_audio():
+            return jsonify({'status': 'done'})
+        render_status = jobs.render_status(upload_id, pdf_file_path)
+        if request.args.get('start') == '1' and (render_status is None
+                                                 or render_status['status'] not in ('queued', 'running')):
+            jobs.submit_render(upload_id, pdf_file_path)
+            render_status = jobs.render_status(upload_id, pdf_file_path)
+        return jsonify(render_status)
+
+    # A job interrupted by a crash or restart picks up again from its last completed page
+    job_status = jobs.status(upload_id, pdf_file_path)
+    if job_status is not None and job_status['status'] == 'interrupted':
+        jobs.submit(upload_id, pdf_file_path, on_done=sessions.invalidate)
+        job_status = jobs.status(upload_id, pdf_file_path)
 
     try:
         data = p.get_data()
+        data['info']['job'] = job_status
 
     except Exception:
         traceback.print_exc()
@@ -114,13 +261,16 @@ def player(upload_id):
         return render_template("./index.html", id=upload_id, data=data, uploads=uploads)
 
     # check if query is valid
-    valid_queries = ['process', 'stream', 'download_pdf', 'download_txt', 'clean', 'remove_doc']
+    valid_queries = ['process', 'stream', 'status', 'export', 'download_pdf', 'download_txt', 'clean', 'remove_doc']
     if query not in valid_queries:
         return render_template("./index.html", dialog="Error: Invalid query")
 
+    elif query in ('process', 'clean', 'remove_doc') and jobs.is_running(upload_id, pdf_file_path):
+        return render_template("./index.html", id=upload_id, data=data, uploads=uploads,
+                               dialog="Error: Document is still being processed")
     elif query == 'process':
         try:
-            p.process()
+            jobs.submit(upload_id, pdf_file_path, on_done=sessions.invalidate)
         except Exception:
             traceback.print_exc()
             r = render_template("./index.html", uploads=uploads, dialog="Error: Failed to process PDF file")
@@ -129,20 +279,37 @@ def player(upload_id):
     elif query == 'clean':
         try:
             p.clean()
+            sessions.invalidate(upload_id)
         except Exception:
             traceback.print_exc()
             r = render_template("./index.html", id=upload_id, data=data, uploads=uploads,
                                 message="Error: Failed to clean processed state for PDF file")
             return r
         return redirect(upload_id)
-    elif query == 'stream':
-        stream_index = request.args.get('index')
-        if not stream_index or not stream_index.isdigit():
-            r = render_template("./index.html", id=upload_id, data=data, uploads=uploads,
-                                dialog="Required integer `index` query param not specified")
+    elif query == 'export':
+        fmt = request.args.get('format', 'wav')
+        if fmt not in EXPORT_FORMATS or not data['info']['is_processed']:
+            return render_template("./index.html", id=upload_id, data=data, uploads=uploads,
+                                   dialog=f"Error: Cannot export this document as `{fmt}`")
+        if p.missing_audio():
+            jobs.submit_render(upload_id, pdf_file_path)
+            r = make_response(render_template("./index.html", id=upload_id, data=data, uploads=uploads,
+                                              dialog="Audio for this document is still being rendered, "
+                                                     "please retry the export once it is done"), 202)
+            r.headers['Retry-After'] = "10"
             return r
-        stream_index = int(stream_index)
-        return Response(p.stream_index(stream_index), mimetype="audio/x-wav")
+        try:
+            chunks, mimetype, size = p.export(fmt, markers=request.args.get('markers') == '1')
+        except Exception:
+            traceback.print_exc()
+            return render_template("./index.html", id=upload_id, data=data, uploads=uploads,
+                                   dialog="Error: Failed to export audio for this document")
+        fname_audio = f"{os.path.splitext(fname_pdf)[0]}.{fmt}"
+        r = Response(chunks, mimetype=mimetype)
+        r.headers['Content-Disposition'] = f'attachment; filename="{fname_audio}"'
+        if size is not None:
+            r.headers['Content-Length'] = size
+        return r
     elif query == 'download_pdf':
         if not os.path.exists(os.path.join(upload_dir_path, fname_pdf)):
             r = render_template("./index.html", id=upload_id, data=data, uploads=uploads,
@@ -157,6 +324,7 @@ def player(upload_id):
         return send_from_directory(upload_dir_path, fname_txt_processed, as_attachment=True)
     elif query == 'remove_doc':
         try:
+            sessions.invalidate(upload_id)
             rrmdir(upload_dir_path)
             # Remove cookie for removed document
             uploads.pop(upload_id)
@@ -169,6 +337,13 @@ def player(upload_id):
         return redirect(url_for('index'))
 
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    r = render_template("./index.html",
+                        message=f"Upload is too large (max {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB)")
+    return r, 413
+
+
 @app.route("/upload", methods=['POST'])
 def upload():
     if request.method != "POST":
@@ -176,6 +351,21 @@ def upload():
     print('-' * 80)
     print("Upload:")
 
+    if not upload_slots.acquire(timeout=app.config['UPLOAD_QUEUE_SECONDS']):
+        r = make_response(render_template("./index.html", message="Server is busy, please retry the upload"), 503)
+        r.headers['Retry-After'] = str(app.config['UPLOAD_QUEUE_SECONDS'])
+        return r
+    try:
+        # Files are written into the upload folder as they arrive, see `UploadRequest`
+        request.upload_folder = app.config['UPLOAD_FOLDER']
+        return handle_upload()
+    finally:
+        # Temporary files of rejected, duplicate or failed uploads
+        request.discard_uploads()
+        upload_slots.release()
+
+
+def handle_upload():
     if 'file' not in request.files:
         r = render_template("./index.html", message='Upload file not found')
         return r
@@ -192,14 +382,8 @@ def upload():
 
         if f and allowed_file(f.filename):
             # upload_id = secrets.token_urlsafe(36)
-            filebytes = f.read()
-            upload_id = hashlib.md5(filebytes).hexdigest()
-
-            f_save_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
-            if not os.path.exists(f_save_path):
-                os.makedirs(f_save_path)
-                f.seek(0)
-                f.save(os.path.join(app.config['UPLOAD_FOLDER'], upload_id, f.filename))
+            upload_id, is_duplicate = store_upload(f, app.config['UPLOAD_FOLDER'])
+            print(f"Stored: {upload_id} [Duplicate={is_duplicate}]")
 
             current_uploads = session.get('uploads', {})
             current_uploads[upload_id] = f.filename
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.wrappers import Request, Response
+
+from app import app, jobs, sessions, accepts_stored, audio_response, parse_index, parse_text_window
+
+########################################################################
+# ASGI Configuration
+########################################################################
+# Threads running the file I/O of the asyncio routes (stores, caches, job status)
+ASYNC_IO_WORKERS = int(os.environ.get('ASYNC_IO_WORKERS', 32))
+# Threads running the requests passed on to the Flask app
+WSGI_WORKERS = int(os.environ.get('WSGI_WORKERS', 10))
+########################################################################
+
+# Every other route (page views, uploads, processing, exports, ...) is served by the Flask app as is
+wsgi = WSGIMiddleware(app, workers=WSGI_WORKERS)
+
+
+def document_pdf(upload_id):
+    # PDF file of a document, or None for missing or invalid documents (whose error pages Flask renders)
+    upload_dir_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+    if not os.path.isdir(upload_dir_path):
+        return None
+    pdf_files = [f for f in os.listdir(upload_dir_path) if f.endswith('.pdf')]
+    return os.path.join(upload_dir_path, pdf_files[0]) if len(pdf_files) == 1 else None
+
+
+def scope_environ(scope):
+    # The parts of a WSGI environ that werkzeug needs to parse query params and conditional request headers
+    environ = {'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'], 'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}", 'wsgi.url_scheme': scope.get('scheme', 'http')}
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f"HTTP_{key}"
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def json_response(data):
+    return Response(json.dumps(data), mimetype="application/json")
+
+
+async def stream(req, upload_id, pdf_file_path):
+    p = await asyncio.to_thread(sessions.get, upload_id, pdf_file_path)
+    stream_index, error = await asyncio.to_thread(parse_index, req, p)
+    if error is not None:
+        return error
+    audio, mimetype = await p.stream_audio_async(stream_index, accept=accepts_stored(req))
+    return await asyncio.to_thread(audio_response, req, p, stream_index, audio, mimetype)
+
+
+async def status(req, upload_id, pdf_file_path):
+    return json_response(await asyncio.to_thread(jobs.status, upload_id, pdf_file_path) or {'status': None})
+
+
+async def text(req, upload_id, pdf_file_path):
+    window, error = parse_text_window(req)
+    if error is not None:
+        return error
+    p = await asyncio.to_thread(sessions.get, upload_id, pdf_file_path)
+    return json_response(await asyncio.to_thread(p.get_text, *window))
+
+
+# `action` query param -> handler, for the routes listeners poll and stream from
+ACTIONS = {'stream': stream, 'status': status, 'text': text}
+
+
+async def send_response(environ, r, send):
+    # Headers and body as a WSGI server would send them: none for HEAD, 1xx, 204 and 304 (without entity headers)
+    headers = r.get_wsgi_headers(environ)
+    await send({'type': 'http.response.start', 'status': r.status_code,
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]})
+    await send({'type': 'http.response.body', 'body': b"".join(r.get_app_iter(environ))})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix="async-io"))
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        match = re.fullmatch(r"/([^/]+)", scope['path'])
+        if match is not None:
+            req = Request(scope_environ(scope))
+            handler = ACTIONS.get(req.args.get('action'))
+            pdf_file_path = None if handler is None else await asyncio.to_thread(document_pdf, match.group(1))
+            if pdf_file_path is not None:
+                return await send_response(req.environ, await handler(req, match.group(1), pdf_file_path), send)
+    await wsgi(scope, receive, send)
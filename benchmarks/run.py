@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ("the of and to in is that for it as was with be by on not he this are or his from at which but have "
+         "an they you were her she there been one all we their has would when if so no will more can other "
+         "audio speech document page model results section figure analysis method data system").split()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {'n': len(samples), 'mean': statistics.mean(samples), 'p50': pick(0.50), 'p90': pick(0.90),
+            'p99': pick(0.99), 'max': samples[-1]}
+
+
+def sentence(rng, citations):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 20))]
+    if rng.random() < citations:
+        words.insert(rng.randint(1, len(words) - 1), rng.choice(["[12]", "(3, 4)", "[7-9]", "{2}"]))
+    return " ".join(words).capitalize() + "."
+
+
+def generate_pdf(path, pages, blocks, tables, citations, seed):
+    import fitz
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        height = (page.rect.height - 100) / blocks
+        for b in range(blocks):
+            rect = fitz.Rect(50, 50 + b * height, page.rect.width - 50, 50 + (b + 1) * height - 5)
+            if rng.random() < tables:
+                # Rows of numbers and symbols, like the remnants of an extracted table
+                text = "\n".join(" ".join(f"{rng.uniform(0, 100):.2f}" for _ in range(6)) + " %" for _ in range(4))
+            else:
+                text = " ".join(sentence(rng, citations) for _ in range(rng.randint(2, 5)))
+            page.insert_textbox(rect, text, fontsize=9)
+    doc.save(path)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def bench_pipeline(pdf_path, args):
+    import fitz
+    from src.PDFProcessor import PDFProcessor
+    from src.TTS import TextToSpeech
+
+    results = {}
+
+    # Raw PyMuPDF block extraction only
+    def extract():
+        doc = fitz.Document(pdf_path)
+        return [page.get_textpage().extractBLOCKS() for page in doc]
+
+    seconds, blocks = timed(extract)
+    results['extract'] = {'seconds': seconds, 'pages_per_second': args.pages / seconds}
+
+    # Paragraph filtering on the extracted blocks
+    paragraphs = [" ".join(s.split("\n")) for page in blocks for b in page
+                  for s in b[4].replace("\n ", "\n").split("\n\n")]
+    processor = PDFProcessor(pdf_path)
+    line_filter = processor.line_filter()
+    removals = {k: [] for k in processor.removals}
+    seconds, _ = timed(lambda: line_filter.filter_batch(paragraphs, removals))
+    results['filter'] = {'seconds': seconds, 'paragraphs': len(paragraphs),
+                         'paragraphs_per_second': len(paragraphs) / seconds}
+
+    # Full PDFProcessor run (extraction, filtering, checkpointing and text exports), each from an empty block cache
+    # so that every run parses the PDF
+    for workers in sorted({1, args.workers}):
+        processor = PDFProcessor(pdf_path)
+        processor.num_workers = workers
+        processor.block_cache.clean()
+        seconds, _ = timed(processor.process)
+        results[f'process_workers_{workers}'] = {'seconds': seconds, 'pages_per_second': args.pages / seconds}
+
+    # Same run again, replaying the blocks cached by the previous one
+    processor = PDFProcessor(pdf_path)
+    seconds, _ = timed(processor.process)
+    results['replay'] = {'seconds': seconds, 'pages_per_second': args.pages / seconds}
+
+    # Sentence splitting of the processed text
+    with open(processor.output_file_path_txt_processed, "r") as f:
+        items = f.readlines()
+    seconds, sentences = timed(lambda: list(TextToSpeech.iter_sentences(TextToSpeech.iter_lines(items))))
+    results['split'] = {'seconds': seconds, 'sentences': len(sentences),
+                        'sentences_per_second': len(sentences) / seconds}
+    return results
+
+
+def bench_synthesis(pdf_path):
+    from src.Backends import get_backend
+    from src.PDFTextToSpeech import PDFTextToSpeech
+
+    # Throughput of our own synthesis path, without the simulated API latency
+    backend = get_backend()
+    latency_ms, backend.latency_ms = backend.latency_ms, 0
+    p = PDFTextToSpeech(pdf_path)
+    p.process()
+    chars = sum(len(p.remove_formatting(t)) for t in p.tts.store.text_list)
+    seconds, _ = timed(p.prerender)
+    num_sentences = len(p.tts.store.text_list)
+    p.clean()
+    backend.latency_ms = latency_ms
+    return {'seconds': seconds, 'sentences': num_sentences, 'chars_per_second': chars / seconds}
+
+
+def bench_serving(pdf_path, args):
+    import app as web
+    from src.AudioCache import get_cache
+
+    # Start cold: drop the audio cached by the synthesis benchmark, it is rebuilt from disk on next use
+    cache = get_cache()
+    shutil.rmtree(cache.cache_dir, ignore_errors=True)
+    cache.entries = None
+
+    upload_id = "bench"
+    upload_dir = os.path.join(web.app.config['UPLOAD_FOLDER'], upload_id)
+    os.makedirs(upload_dir, exist_ok=True)
+    shutil.copy(pdf_path, upload_dir)
+    client = web.app.test_client()
+
+    client.get(f"/{upload_id}?action=process")
+    while client.get(f"/{upload_id}?action=status").json['status'] not in ('done', 'failed'):
+        time.sleep(0.05)
+
+    p = web.sessions.get(upload_id, os.path.join(upload_dir, os.path.basename(pdf_path)))
+    num_sentences = p.num_sentences()
+    # Spaced out so that read-ahead of one request does not warm up the next
+    indices = list(range(0, num_sentences, p.tts.read_ahead + 2))[:args.requests]
+
+    def request(i):
+        start = time.perf_counter()
+        r = client.get(f"/{upload_id}?action=stream&index={i}")
+        assert r.status_code == 200, r.status_code
+        return time.perf_counter() - start
+
+    cold = [request(i) for i in indices]
+    warm = [request(i) for i in indices]
+    seconds, _ = timed(lambda: client.get(f"/{upload_id}"))
+    return {'stream_cold': percentiles(cold), 'stream_warm': percentiles(warm), 'page_view_seconds': seconds}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PDF text-to-speech pipeline and serving path")
+    parser.add_argument("--pages", type=int, default=100, help="Pages in the synthetic PDF")
+    parser.add_argument("--blocks", type=int, default=8, help="Text blocks per page")
+    parser.add_argument("--tables", type=float, default=0.1, help="Fraction of blocks that are numeric tables")
+    parser.add_argument("--citations", type=float, default=0.3,
+                        help="Fraction of sentences with an in-text citation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Extraction worker processes")
+    parser.add_argument("--requests", type=int, default=50, help="Stream requests for latency percentiles")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Simulated TTS API latency")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pdf-tts-bench-")
+    # Stub TTS backend and throwaway storage, set before anything from the app is imported
+    os.environ.update({'TTS_BACKEND': 'fake', 'TTS_FAKE_LATENCY_MS': str(args.latency_ms),
+                       'TTS_CACHE_FOLDER': os.path.join(work_dir, "tts_cache"),
+                       'UPLOAD_FOLDER': os.path.join(work_dir, "uploads"),
+                       'FLASK_DEBUG': 'False', 'TEMPLATES_AUTO_RELOAD': 'False', 'SECRET_KEY': 'bench'})
+    try:
+        pdf_path = os.path.join(work_dir, "bench.pdf")
+        generate_pdf(pdf_path, args.pages, args.blocks, args.tables, args.citations, args.seed)
+
+        results = {'commit': git_commit(), 'timestamp': time.time(), 'config': vars(args)}
+        # The pipeline and app log progress to stdout, keep it free for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results['pipeline'] = bench_pipeline(pdf_path, args)
+            results['synthesis'] = bench_synthesis(pdf_path)
+            results['serving'] = bench_serving(pdf_path, args)
+        # ru_maxrss is in kilobytes on Linux
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencies that requests served from stored audio must not load
+HEAVY_MODULES = ["fitz", "tqdm", "google.cloud.texttospeech", "grpc"]
+
+# Runs in a fresh interpreter, like a newly started worker: times the import of the app and its first requests
+WORKER = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+results = {'import_seconds': time.perf_counter() - start}
+client = app.app.test_client()
+for name, url in [('index', '/'), ('download_pdf', f'/{sys.argv[2]}?action=download_pdf'),
+                  ('stream', f'/{sys.argv[2]}?action=stream&index=0')]:
+    start = time.perf_counter()
+    assert client.get(url).status_code == 200, url
+    results[f'first_{name}_seconds'] = time.perf_counter() - start
+results['heavy_modules'] = [m for m in json.loads(sys.argv[4]) if m in sys.modules]
+with open(sys.argv[3], 'w') as f:
+    json.dump(results, f)
+"""
+
+
+def prepare_document(work_dir, env):
+    # A document with all of its audio stored, so that no request needs to synthesize
+    pdf_path = os.path.join(ROOT, "pdf-sample.pdf")
+    subprocess.run([sys.executable, os.path.join(ROOT, "prerender.py"), pdf_path,
+                    "--upload-folder", env['UPLOAD_FOLDER']], env=dict(env, TTS_BACKEND="fake"), cwd=work_dir,
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(pdf_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def start_worker(work_dir, env, upload_id):
+    out_path = os.path.join(work_dir, "startup.json")
+    worker = subprocess.run([sys.executable, "-c", WORKER, ROOT, upload_id, out_path, json.dumps(HEAVY_MODULES)],
+                            env=env, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if worker.returncode != 0:
+        raise Exception(f"Worker failed to serve its first requests:\n{worker.stderr}")
+    with open(out_path, "r") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the start-up time of a web worker against a budget")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh worker processes to start, the median is kept")
+    parser.add_argument("--backend", default=os.environ.get('TTS_BACKEND', 'google'),
+                        help="TTS_BACKEND of the workers (it must not be loaded, as no request synthesizes)")
+    parser.add_argument("--import-budget-ms", type=float, default=400, help="Budget for importing the app")
+    parser.add_argument("--request-budget-ms", type=float, default=200,
+                        help="Budget for each of the first requests (page view, PDF download, stored audio)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pdf-tts-startup-")
+    env = dict(os.environ, TTS_BACKEND=args.backend, UPLOAD_FOLDER=os.path.join(work_dir, "uploads"),
+               TTS_CACHE_FOLDER=os.path.join(work_dir, "tts_cache"), FLASK_DEBUG="False",
+               TEMPLATES_AUTO_RELOAD="False", SECRET_KEY="startup", PRELOAD="0")
+    try:
+        upload_id = prepare_document(work_dir, env)
+        runs = [start_worker(work_dir, env, upload_id) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {name: statistics.median(run[name] for run in runs) for name in runs[0] if name.endswith("_seconds")}
+    results['heavy_modules'] = sorted({m for run in runs for m in run['heavy_modules']})
+    failures = []
+    if results['import_seconds'] * 1000 > args.import_budget_ms:
+        failures.append(f"import took {results['import_seconds'] * 1000:.0f} ms")
+    for name, seconds in results.items():
+        if name.startswith("first_") and seconds * 1000 > args.request_budget_ms:
+            failures.append(f"{name} took {seconds * 1000:.0f} ms")
+    if results['heavy_modules']:
+        failures.append(f"loaded {', '.join(results['heavy_modules'])}")
+    results['failures'] = failures
+
+    print(json.dumps(results, indent=4))
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
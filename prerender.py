@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from werkzeug.datastructures import FileStorage
+
+from src.Jobs import JobManager
+from src.Metrics import TTS_API_SECONDS
+from src.PDFTextToSpeech import PDFTextToSpeech
+from src.Scheduler import get_scheduler
+from src.Uploads import store_upload
+
+
+class Totals:
+    # Work done across all documents of a run, for the throughput report
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.failed = 0
+        self.pages = 0
+        self.sentences = 0
+        self.chars = 0
+        # upload_ids taken by a worker, the same document may be listed more than once
+        self.claimed = set()
+
+    def claim(self, upload_id):
+        with self.lock:
+            if upload_id in self.claimed:
+                return False
+            self.claimed.add(upload_id)
+            return True
+
+    def add(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+
+def find_pdfs(sources):
+    # PDF files of directories (recursively), manifests (one path per line) and plain PDF paths
+    pdfs = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                pdfs += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith('.pdf')]
+        elif source.lower().endswith('.pdf'):
+            pdfs.append(source)
+        else:
+            base = os.path.dirname(os.path.abspath(source))
+            with open(source, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        pdfs.append(os.path.join(base, line))
+    return pdfs
+
+
+def add_to_library(pdf_path, upload_folder):
+    # Copies the PDF into `<upload_folder>/<md5>/`, the layout the web app reads, unless it is already there
+    with open(pdf_path, "rb") as f:
+        upload_id, _ = store_upload(FileStorage(stream=f, filename=os.path.basename(pdf_path)), upload_folder)
+    upload_dir_path = os.path.join(upload_folder, upload_id)
+    pdf_files = [f for f in os.listdir(upload_dir_path) if f.endswith('.pdf')]
+    return upload_id, os.path.join(upload_dir_path, pdf_files[0])
+
+
+def prerender_document(pdf_path, args, totals):
+    try:
+        upload_id, pdf_file_path = add_to_library(pdf_path, args.upload_folder)
+    except Exception:
+        traceback.print_exc()
+        totals.add(failed=1)
+        print(f"FAILED: {pdf_path}")
+        return
+    if not totals.claim(upload_id):
+        print(f"SKIPPED: {pdf_path} is a duplicate of {upload_id}")
+        return
+    # The web app (or another run) may be processing the same document
+    job_lock = JobManager.try_lock(PDFTextToSpeech.job_file_path(pdf_file_path))
+    if job_lock is None:
+        print(f"SKIPPED: {pdf_path} is being processed by another process")
+        return
+    p = PDFTextToSpeech(pdf_file_path)
+    p.pdf_processor.num_workers = args.extraction_workers
+    p.tts.prerender_workers = args.synthesis_workers
+    try:
+        # Documents finished by an earlier run (or the web app) are not processed again, an interrupted one
+        # resumes from its last completed page
+        status = JobManager.load_status(p.output_filepath_job)
+        if status is None or status['status'] != 'done' or not p.tts.store.exists():
+            started = time.time()
+            status = {'status': 'running', 'pages_done': 0, 'pages_total': None, 'blocks_done': 0,
+                      'started': started, 'updated': started, 'resumed_from': None}
+
+            def progress(pages_done, pages_total, num_blocks):
+                if status['resumed_from'] is None:
+                    status['resumed_from'] = pages_done - 1
+                status.update({'pages_done': pages_done, 'pages_total': pages_total,
+                               'blocks_done': status['blocks_done'] + num_blocks, 'updated': time.time()})
+                JobManager.save_status(p, status)
+                totals.add(pages=1)
+
+            JobManager.save_status(p, status)
+            p.process(progress=progress)
+            status.update({'status': 'done', 'updated': time.time()})
+            JobManager.save_status(p, status)
+
+        # Only sentences without audio are synthesized, so a restarted run continues where it stopped
+        store = p.tts.store
+        store.refresh()
+        missing = {i: len(p.remove_formatting(text).strip()) for i, text in enumerate(store.text_list)
+                   if not store.has(i)}
+        p.prerender()
+        store.refresh()
+        rendered = [i for i in missing if store.has(i)]
+        totals.add(documents=1, sentences=len(rendered), chars=sum(missing[i] for i in rendered))
+        print(f"DONE: {pdf_path} -> {upload_id} ({len(rendered)} sentences synthesized)")
+    except Exception:
+        traceback.print_exc()
+        totals.add(failed=1)
+        print(f"FAILED: {pdf_path}")
+    finally:
+        p.close()
+        job_lock.close()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Process PDFs and synthesize all of their audio ahead of time, "
+                                                 "into the upload folder served by the web app")
+    parser.add_argument("sources", nargs="+",
+                        help="PDF files, directories of PDFs, or manifest files listing one PDF path per line")
+    parser.add_argument("--upload-folder", default=os.environ.get('UPLOAD_FOLDER', 'uploads'),
+                        help="Library the documents are written to (Default: UPLOAD_FOLDER)")
+    parser.add_argument("--jobs", type=int, default=2, help="Documents processed at the same time")
+    parser.add_argument("--extraction-workers", type=int, default=1,
+                        help="Processes each document uses to extract PDF pages")
+    parser.add_argument("--synthesis-workers", type=int, default=4,
+                        help="TTS API calls made at the same time per document")
+    parser.add_argument("--output", help="Also write the throughput report as JSON to this file")
+    args = parser.parse_args()
+
+    pdfs = find_pdfs(args.sources)
+    os.makedirs(args.upload_folder, exist_ok=True)
+    print(f"PRERENDER: {len(pdfs)} documents into {args.upload_folder}")
+
+    totals = Totals()
+    api_calls = TTS_API_SECONDS.count()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="documents") as executor:
+        list(executor.map(lambda pdf_path: prerender_document(pdf_path, args, totals), pdfs))
+    seconds = time.perf_counter() - start
+    api_calls = TTS_API_SECONDS.count() - api_calls
+
+    report = {'documents': totals.documents, 'failed': totals.failed, 'seconds': seconds,
+              'pages': totals.pages, 'sentences': totals.sentences, 'chars': totals.chars, 'api_calls': api_calls,
+              'pages_per_second': totals.pages / seconds, 'chars_per_second': totals.chars / seconds,
+              'api_calls_per_second': api_calls / seconds, 'scheduler': get_scheduler().stats()}
+    print("=" * 80)
+    for name, value in report.items():
+        print(f"{name} = {value:.2f}" if isinstance(value, float) else f"{name} = {value}")
+    print("=" * 80)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if totals.failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from src.Metrics import AUDIO_CACHE_IO_SECONDS
+
+# Cache shared by all documents in the process
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AudioCache(os.environ.get('TTS_CACHE_FOLDER', 'tts_cache'),
+                                max_bytes=int(os.environ.get('TTS_CACHE_MB', 1024)) * 1024 * 1024)
+        return _cache
+
+
+class AudioCache:
+    # Content-addressed audio cache, keyed by the synthesized text and the voice configuration
+    # Entries are stored encoded with the storage codec: a header of (encoding, length in bytes of the decoded PCM
+    # audio), then the encoded audio (entries written before that are plain WAV, which starts with `RIFF`)
+    entry_header = struct.Struct("<BI")
+    ENCODING_LINEAR16 = 0
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        # key -> size in bytes, least recently used first
+        self.entries = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(text, voice_config):
+        data = json.dumps([text.strip(), voice_config], sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.audio")
+
+    def _load_entries(self):
+        # Rebuild the LRU order from file modification times on first use
+        if self.entries is not None:
+            return
+        found = []
+        if os.path.isdir(self.cache_dir):
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".audio"):
+                        st = entry.stat()
+                        found.append((st.st_mtime, entry.name[:-len(".audio")], st.st_size))
+        found.sort()
+        self.entries = OrderedDict((key, size) for _, key, size in found)
+        self.total_bytes = sum(self.entries.values())
+
+    def load(self):
+        with self.lock:
+            self._load_entries()
+
+    def get(self, key):
+        # (encoding, data, decoded PCM length or 0 if unknown) of a cached entry, or None
+        path = self.path(key)
+        start = time.perf_counter()
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            AUDIO_CACHE_IO_SECONDS.observe(time.perf_counter() - start, "read")
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+            evicted = False
+        except FileNotFoundError:
+            # Evicted since it was read (by another thread or process), the data read is still valid
+            evicted = True
+        with self.lock:
+            self._load_entries()
+            if evicted:
+                if key in self.entries:
+                    self.total_bytes -= self.entries.pop(key)
+            else:
+                if key not in self.entries:
+                    # Written by another process
+                    self.entries[key] = len(audio)
+                    self.total_bytes += len(audio)
+                self.entries.move_to_end(key)
+            self.hits += 1
+        if audio[:4] == b"RIFF":
+            return self.ENCODING_LINEAR16, audio, 0
+        encoding, pcm_length = self.entry_header.unpack_from(audio)
+        return encoding, audio[self.entry_header.size:], pcm_length
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def put(self, key, data, encoding=ENCODING_LINEAR16, pcm_length=0):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with AUDIO_CACHE_IO_SECONDS.time("write"):
+            with open(tmp_path, "wb") as f:
+                f.write(self.entry_header.pack(encoding, pcm_length))
+                f.write(data)
+            os.replace(tmp_path, path)
+        size = self.entry_header.size + len(data)
+        with self.lock:
+            self._load_entries()
+            self.total_bytes += size - self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': None if self.entries is None else len(self.entries),
+                    'bytes': self.total_bytes}
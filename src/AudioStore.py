@@ -0,0 +1,351 @@
+import fcntl
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+from contextlib import contextmanager
+
+# Open file description locks (Linux), byte-range locks owned by the descriptor rather than the whole process,
+# so threads holding locks on different sentences cannot deadlock each other across processes
+F_OFD_SETLKW = getattr(fcntl, 'F_OFD_SETLKW', None)
+
+
+class AudioStore:
+    # Index record layout: (sentence index, offset in audio file, length in bytes, encoding,
+    # length in bytes of the decoded PCM audio, 0 if unknown)
+    index_record = struct.Struct("<IQIBI")
+    # Records of indexes written before the decoded length was recorded (version 0)
+    index_record_v0 = struct.Struct("<IQIB")
+    INDEX_VERSION = 1
+    # Encoding of the stored audio blobs
+    ENCODING_LINEAR16 = 0
+    # First index record of a generation: (MARKER_INDEX, generation of the matching text file, INDEX_VERSION,
+    # MARKER_ENCODING, 0)
+    # The generation is a random token also written in the header line of the text file (inodes are reused as
+    # soon as a file is replaced, so they cannot tell generations apart)
+    MARKER_INDEX = 0xFFFFFFFF
+    MARKER_ENCODING = 0xFF
+    # Share of the audio file no longer referenced after a rebase above which the carried segments are copied to
+    # a new audio file
+    COMPACT_UNREFERENCED = 0.25
+
+    def __init__(self, output_file_path_base):
+        # Header line with the generation, then one sentence per line, JSON encoded
+        self.output_filepath_text = f"{output_file_path_base}.text"
+        # Append-only audio segments, addressed through the index
+        self.output_filepath_audio = f"{output_file_path_base}.audio"
+        # Append-only fixed size index records, last record for a sentence wins
+        self.output_filepath_index = f"{output_file_path_base}.index"
+        # Legacy whole-file pickle cache, converted on load
+        self.output_filepath_seqs = f"{output_file_path_base}.seqs"
+        # Coordinates writers and synthesis across processes (e.g. several web server workers)
+        self.output_filepath_lock = f"{output_file_path_base}.lock"
+
+        self.text_list = None
+        # Total length of the sentences in text_list, kept up to date for `memory_usage()`
+        self.text_chars = 0
+        self.index = {}
+        # Generation and bytes already read of the text and index files, see `refresh()`
+        self.generation = None
+        self.text_offset = 0
+        self.index_offset = 0
+        # Record layout of the index file, appends keep the layout it was written with
+        self.record = self.index_record_v0
+        self.audio_mmap = None
+        # Guards appends and remapping, segments are read and written from several threads
+        self.lock = threading.Lock()
+
+        self.migrate_seqs()
+        self.load()
+
+    def load(self):
+        self.close()
+        with self.lock:
+            self.text_list = None
+            self.text_chars = 0
+            self.index = {}
+            self.generation = None
+            self.text_offset = 0
+            self.index_offset = 0
+            self.record = self.index_record_v0
+            try:
+                f = open(self.output_filepath_text, "rb")
+            except FileNotFoundError:
+                return
+            with f:
+                self.text_list = []
+                self.generation, self.text_offset = self._read_header(f)
+                self._read_tail(f)
+
+    def refresh(self):
+        # Picks up sentences and audio appended by other store instances (e.g. a processing job)
+        try:
+            f = open(self.output_filepath_text, "rb")
+        except FileNotFoundError:
+            if self.text_list is not None:
+                self.load()
+            return
+        with f:
+            # Replaced (re-processed, or cleaned and created again) since it was loaded
+            if self.text_list is None or self._read_header(f)[0] != self.generation:
+                f.close()
+                self.load()
+                return
+            with self.lock:
+                self._read_tail(f)
+
+    @staticmethod
+    def _read_header(f):
+        # (generation, header size) of an open text file, (None, 0) for files written before generations
+        f.seek(0)
+        line = f.readline()
+        if line.endswith(b"\n"):
+            header = json.loads(line)
+            if isinstance(header, dict):
+                return header['generation'], len(line)
+        return None, 0
+
+    def _read_tail(self, f):
+        f.seek(self.text_offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Line still being written
+                break
+            text = json.loads(line)
+            self.text_list.append(text)
+            self.text_chars += len(text)
+            self.text_offset += len(line)
+        if not os.path.isfile(self.output_filepath_index):
+            return
+        with open(self.output_filepath_index, "rb") as f:
+            # The marker is checked on every read, the index may have been replaced after the text was read
+            # (its first fields have the same layout in every version)
+            head = f.read(self.index_record_v0.size)
+            is_marker = False
+            version = 0
+            if len(head) == self.index_record_v0.size:
+                i, generation, version, encoding = self.index_record_v0.unpack(head)
+                is_marker = i == self.MARKER_INDEX and encoding == self.MARKER_ENCODING
+            if self.generation is not None and not (is_marker and generation == self.generation):
+                # Index of another text generation, the matching one is about to replace it
+                return
+            self.record = self.index_record if is_marker and version >= 1 else self.index_record_v0
+            if self.index_offset == 0 and is_marker:
+                self.index_offset = self.record.size
+            f.seek(self.index_offset)
+            buf = f.read()
+        # Ignore a trailing partial record left by an interrupted write
+        usable = len(buf) - len(buf) % self.record.size
+        for i, offset, length, encoding, *pcm_length in self.record.iter_unpack(buf[:usable]):
+            self.index[i] = (offset, length, encoding, pcm_length[0] if pcm_length else 0)
+        self.index_offset += usable
+
+    def _current_generation(self):
+        try:
+            with open(self.output_filepath_text, "rb") as f:
+                return self._read_header(f)[0]
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def write_lock(self):
+        # Held while appending to or replacing the store files, by any store of this document in any process
+        with open(self.output_filepath_lock, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def synthesis_lock(self, i):
+        # Held while synthesizing sentence i, so other processes wait for its audio instead of synthesizing it again
+        if F_OFD_SETLKW is None:
+            # Other platforms only coordinate the threads of a process, through the Prefetcher
+            yield
+            return
+        with open(self.output_filepath_lock, "ab") as f:
+            # struct flock: (l_type, l_whence, l_start, l_len, l_pid)
+            fcntl.fcntl(f, F_OFD_SETLKW, struct.pack("hhqqi", fcntl.F_WRLCK, os.SEEK_SET, i, 1, 0))
+            yield
+
+    def create(self, text_list):
+        self.rebase(text_list, None)
+
+    def rebase(self, text_list, carry):
+        # Replaces the sentences, keeping the audio of old sentence carry[i] for new sentence i
+        # (the audio file is kept as is unless too much of it is left unreferenced, see `_compact()`)
+        # or starting over with no audio at all if carry is None
+        with self.lock, self.write_lock():
+            if carry is None:
+                carry = {}
+                self._unmap()
+                if os.path.exists(self.output_filepath_audio):
+                    os.remove(self.output_filepath_audio)
+            generation = int.from_bytes(os.urandom(8), "little")
+            tmp_path = f"{self.output_filepath_text}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps({'generation': generation}) + "\n")
+                for text in text_list:
+                    f.write(json.dumps(text) + "\n")
+            st = os.stat(tmp_path)
+            index = {i: self.index[j] for i, j in carry.items() if j in self.index}
+            tmp_audio_path = self._compact(index)
+            tmp_index_path = f"{self.output_filepath_index}.tmp"
+            with open(tmp_index_path, "wb") as f:
+                # Readers only use an index whose marker matches the text file they loaded
+                f.write(self.index_record.pack(self.MARKER_INDEX, generation, self.INDEX_VERSION,
+                                               self.MARKER_ENCODING, 0))
+                f.write(b"".join(self.index_record.pack(i, *entry) for i, entry in sorted(index.items())))
+            # Audio first, an instance picking up the new index always maps the matching audio file
+            if tmp_audio_path is not None:
+                self._unmap()
+                os.replace(tmp_audio_path, self.output_filepath_audio)
+            os.replace(tmp_path, self.output_filepath_text)
+            os.replace(tmp_index_path, self.output_filepath_index)
+            self.text_list = list(text_list)
+            self.text_chars = sum(len(text) for text in text_list)
+            self.index = index
+            self.generation = generation
+            self.record = self.index_record
+            self.text_offset = st.st_size
+            self.index_offset = self.index_record.size * (len(index) + 1)
+
+    def _compact(self, index):
+        # Copies the carried segments of `index` to a new audio file when too much of the current one is unreferenced,
+        # returns its path with `index` updated to the new offsets, or None to keep the current file
+        try:
+            size = os.path.getsize(self.output_filepath_audio)
+        except FileNotFoundError:
+            return None
+        # Several new sentences may carry the same old segment
+        segments = sorted({entry[:2] for entry in index.values()})
+        if size - sum(length for _, length in segments) <= size * self.COMPACT_UNREFERENCED:
+            return None
+        offsets = {}
+        tmp_path = f"{self.output_filepath_audio}.tmp"
+        with open(self.output_filepath_audio, "rb") as src, open(tmp_path, "wb") as dst:
+            for offset, length in segments:
+                offsets[offset, length] = dst.tell()
+                src.seek(offset)
+                dst.write(src.read(length))
+        for i, entry in index.items():
+            index[i] = (offsets[entry[:2]],) + entry[1:]
+        return tmp_path
+
+    def append_text(self, text_list):
+        with self.lock, self.write_lock():
+            buf = "".join(json.dumps(text) + "\n" for text in text_list).encode()
+            with open(self.output_filepath_text, "ab") as f:
+                f.write(buf)
+            self.text_list.extend(text_list)
+            self.text_chars += sum(len(text) for text in text_list)
+            self.text_offset += len(buf)
+
+    def get(self, i):
+        entry = self.index.get(i)
+        if entry is None:
+            return None
+        return self.read(i, 0, entry[1])
+
+    def read(self, i, start, stop):
+        # Part of a stored segment, without copying the rest of it
+        entry = self.index.get(i)
+        if entry is None:
+            return None
+        offset, length = entry[:2]
+        stop = min(stop, length)
+        with self.lock:
+            if self.audio_mmap is None or offset + length > len(self.audio_mmap):
+                self._remap()
+            # Audio removed or replaced by another instance, this one is stale until its next `refresh()`
+            if self.audio_mmap is None or offset + length > len(self.audio_mmap):
+                return None
+            return self.audio_mmap[offset + start:offset + stop]
+
+    def encoding(self, i):
+        entry = self.index.get(i)
+        return None if entry is None else entry[2]
+
+    def length(self, i):
+        entry = self.index.get(i)
+        return None if entry is None else entry[1]
+
+    def pcm_length(self, i):
+        # Length of the decoded PCM audio, None if it was not recorded
+        entry = self.index.get(i)
+        return None if entry is None or entry[3] == 0 else entry[3]
+
+    def put(self, i, audio, encoding=ENCODING_LINEAR16, pcm_length=0):
+        # Appends from other processes are serialized by the write lock, so the offset is where the audio lands
+        with self.lock, self.write_lock():
+            # The document was re-processed or cleaned by another instance, the audio belongs to none of its sentences
+            if self._current_generation() != self.generation:
+                return
+            with open(self.output_filepath_audio, "ab") as f:
+                offset = f.tell()
+                f.write(audio)
+            entry = (offset, len(audio), encoding, pcm_length)
+            with open(self.output_filepath_index, "ab") as f:
+                f.write(self.record.pack(i, *(entry if self.record is self.index_record else entry[:3])))
+            self.index[i] = entry
+
+    def has(self, i):
+        return i in self.index
+
+    def num_cached(self):
+        return len(self.index)
+
+    def memory_usage(self):
+        # Rough estimate of the resident size: sentence text plus index entries
+        if self.text_list is None:
+            return 0
+        return self.text_chars + 100 * (len(self.text_list) + len(self.index))
+
+    def exists(self):
+        return self.text_list is not None
+
+    def _remap(self):
+        self._unmap()
+        try:
+            with open(self.output_filepath_audio, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                self.audio_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+
+    def _unmap(self):
+        if self.audio_mmap is not None:
+            self.audio_mmap.close()
+            self.audio_mmap = None
+
+    def migrate_seqs(self):
+        if not os.path.isfile(self.output_filepath_seqs) or os.path.isfile(self.output_filepath_text):
+            return
+        print(f"AUDIO-STORE: Migrating {self.output_filepath_seqs}")
+        with open(self.output_filepath_seqs, "rb") as f:
+            text_audio_map = pickle.load(f)
+        self.create([text for text, _ in text_audio_map])
+        for i, (_, audio) in enumerate(text_audio_map):
+            if audio is not None:
+                self.put(i, audio)
+        os.remove(self.output_filepath_seqs)
+
+    def clean(self):
+        self.close()
+        with self.write_lock():
+            for path in (self.output_filepath_text, self.output_filepath_audio,
+                         self.output_filepath_index, self.output_filepath_seqs):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.text_list = None
+        self.text_chars = 0
+        self.index = {}
+        self.generation = None
+        self.text_offset = 0
+        self.index_offset = 0
+        self.record = self.index_record_v0
@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import math
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import threading
+import time
+
+from src.Codecs import ffmpeg
+from src.Wav import gen_wav, parse_wav
+
+# Backend shared by all documents in the process, selected with the TTS_BACKEND environment variable
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend_class():
+    name = os.environ.get('TTS_BACKEND', 'google')
+    if name not in BACKENDS:
+        raise Exception(f"Invalid TTS_BACKEND `{name}`, must be one of {sorted(BACKENDS)}")
+    return BACKENDS[name]
+
+
+def get_backend():
+    # Created on the first synthesis, requests served from stored audio never load the client library
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = backend_class()()
+            print(f"TTS BACKEND: {_backend.name}")
+        return _backend
+
+
+class TransientError(Exception):
+    # Failed call worth retrying later, such as an exhausted quota or an unavailable service
+    pass
+
+
+class Backend:
+    # synthesize(text, voice_config) returns LINEAR16 audio framed as WAV, like the Google API does
+    name = None
+    # Whether synthesize_marked() is available for batching sentences at <mark> timepoints
+    supports_marks = False
+
+    @staticmethod
+    def preload():
+        # Imports the client library without creating a client
+        pass
+
+    def synthesize(self, text, voice_config):
+        raise NotImplementedError
+
+    def synthesize_marked(self, ssml, voice_config):
+        # Returns (audio, {mark name: offset in seconds})
+        raise NotImplementedError
+
+    async def synthesize_async(self, text, voice_config):
+        # Backends without a non-blocking client run the blocking call in the default thread pool
+        return await asyncio.to_thread(self.synthesize, text, voice_config)
+
+    def is_retryable(self, e):
+        return isinstance(e, TransientError)
+
+
+class GoogleBackend(Backend):
+    name = 'google'
+    supports_marks = True
+
+    @staticmethod
+    def preload():
+        from google.cloud import texttospeech, texttospeech_v1beta1  # noqa: F401
+
+    def __init__(self):
+        from google.api_core import exceptions
+        from google.cloud import texttospeech, texttospeech_v1beta1
+        # Quota, availability and timeout errors, the others are not resolved by retrying
+        self.retryable_errors = (exceptions.TooManyRequests, exceptions.ResourceExhausted,
+                                 exceptions.ServiceUnavailable, exceptions.InternalServerError,
+                                 exceptions.DeadlineExceeded)
+        self.texttospeech = texttospeech
+        self.texttospeech_v1beta1 = texttospeech_v1beta1
+        self.client = texttospeech.TextToSpeechClient()
+        # SSML <mark> timepoints are only available in the v1beta1 API
+        self.batch_client = texttospeech_v1beta1.TextToSpeechClient()
+        # gRPC asyncio client, created on first use since it is bound to the running event loop
+        self.async_client = None
+
+    @staticmethod
+    def voice_params(tts, voice_config):
+        return {'voice': tts.VoiceSelectionParams(language_code=voice_config['language_code'],
+                                                  ssml_gender=tts.SsmlVoiceGender[voice_config['ssml_gender']]),
+                'audio_config': tts.AudioConfig(audio_encoding=tts.AudioEncoding[voice_config['audio_encoding']],
+                                                speaking_rate=voice_config['speaking_rate'],
+                                                pitch=voice_config['pitch'])}
+
+    def synthesize(self, text, voice_config):
+        tts = self.texttospeech
+        response = self.client.synthesize_speech(input=tts.SynthesisInput(text=text),
+                                                 **self.voice_params(tts, voice_config))
+        return response.audio_content
+
+    def is_retryable(self, e):
+        return isinstance(e, self.retryable_errors) or super().is_retryable(e)
+
+    async def synthesize_async(self, text, voice_config):
+        tts = self.texttospeech
+        if self.async_client is None:
+            self.async_client = tts.TextToSpeechAsyncClient()
+        response = await self.async_client.synthesize_speech(input=tts.SynthesisInput(text=text),
+                                                             **self.voice_params(tts, voice_config))
+        return response.audio_content
+
+    def synthesize_marked(self, ssml, voice_config):
+        tts = self.texttospeech_v1beta1
+        response = self.batch_client.synthesize_speech(request=tts.SynthesizeSpeechRequest(
+            input=tts.SynthesisInput(ssml=ssml), **self.voice_params(tts, voice_config),
+            enable_time_pointing=[tts.SynthesizeSpeechRequest.TimepointType.SSML_MARK]))
+        return response.audio_content, {t.mark_name: t.time_seconds for t in response.timepoints}
+
+
+class LocalBackend(Backend):
+    # Offline synthesis through the espeak-ng command line tool
+    name = 'local'
+
+    def __init__(self):
+        self.executable = shutil.which(os.environ.get('TTS_LOCAL_EXECUTABLE', 'espeak-ng')) or shutil.which('espeak')
+        if self.executable is None:
+            raise Exception("TTS_BACKEND=local requires `espeak-ng` (or `espeak`) to be installed")
+        if shutil.which("ffmpeg") is None:
+            raise Exception("TTS_BACKEND=local requires `ffmpeg` to be installed, to resample the espeak audio")
+
+    def synthesize(self, text, voice_config):
+        # espeak speaks at ~175 words per minute by default
+        words_per_minute = str(int(175 * voice_config['speaking_rate']))
+        pitch = str(int(min(max(50 + voice_config['pitch'] * 2.5, 0), 99)))
+        voice = voice_config['language_code'].lower()
+        if voice_config['ssml_gender'] == 'FEMALE':
+            voice += "+f3"
+        out = subprocess.run([self.executable, "--stdout", "-v", voice, "-s", words_per_minute, "-p", pitch, text],
+                             check=True, capture_output=True).stdout
+        sample_rate, bits_per_sample, channels, data_offset, data_size = parse_wav(out)
+        pcm = out[data_offset:data_offset + data_size]
+        if sample_rate != voice_config['sample_rate'] and data_size:
+            # espeak produces 22050 Hz audio, stored segments all use the configured rate
+            pcm = ffmpeg(["-f", "wav", "-i", "pipe:0", "-ar", str(voice_config['sample_rate']),
+                          "-c:a", "pcm_s16le", "-f", "s16le", "pipe:1"], out)
+            bits_per_sample = 16
+        return gen_wav(pcm, voice_config['sample_rate'], bits_per_sample, channels)
+
+
+class FakeBackend(Backend):
+    # Deterministic stand-in producing tones of realistic duration, for load testing and benchmarks
+    name = 'fake'
+    supports_marks = True
+
+    def __init__(self):
+        ########################################################################
+        # Fake Backend Configuration
+        ########################################################################
+        # Simulated API round-trip time in milliseconds, plus random jitter up to the same amount
+        self.latency_ms = float(os.environ.get('TTS_FAKE_LATENCY_MS', 0))
+        # Speaking speed used to derive the audio duration from the text length
+        self.chars_per_second = float(os.environ.get('TTS_FAKE_CHARS_PER_SECOND', 15))
+        # Fraction of calls failing with a simulated quota error
+        self.error_rate = float(os.environ.get('TTS_FAKE_ERROR_RATE', 0))
+        ########################################################################
+
+    def _latency(self):
+        return self.latency_ms * (1 + random.random()) / 1000
+
+    def _wait(self):
+        if self.latency_ms > 0:
+            time.sleep(self._latency())
+        self._fail()
+
+    def _fail(self):
+        if random.random() < self.error_rate:
+            raise TransientError("Simulated quota exceeded")
+
+    def _pcm(self, text, voice_config):
+        sample_rate = voice_config['sample_rate']
+        num_samples = int(len(text.strip()) / self.chars_per_second / voice_config['speaking_rate'] * sample_rate)
+        # Tone frequency derived from the text, so the same text always gives the same audio
+        digest = hashlib.md5(text.encode()).digest()
+        period = sample_rate // (200 + digest[0] * 2)
+        cycle = b"".join(struct.pack("<h", int(8000 * math.sin(2 * math.pi * n / period))) for n in range(period))
+        return (cycle * (num_samples // period + 1))[:num_samples * 2]
+
+    def synthesize(self, text, voice_config):
+        self._wait()
+        return gen_wav(self._pcm(text, voice_config), voice_config['sample_rate'], 16, 1)
+
+    async def synthesize_async(self, text, voice_config):
+        if self.latency_ms > 0:
+            await asyncio.sleep(self._latency())
+        self._fail()
+        return gen_wav(self._pcm(text, voice_config), voice_config['sample_rate'], 16, 1)
+
+    def synthesize_marked(self, ssml, voice_config):
+        self._wait()
+        pcm = b""
+        marks = {}
+        for name, text in re.findall(r'<mark name="([^"]*)"/>([^<]*)', ssml):
+            marks[name] = len(pcm) / 2 / voice_config['sample_rate']
+            pcm += self._pcm(text, voice_config)
+        return gen_wav(pcm, voice_config['sample_rate'], 16, 1), marks
+
+
+BACKENDS = {
+    GoogleBackend.name: GoogleBackend,
+    LocalBackend.name: LocalBackend,
+    FakeBackend.name: FakeBackend,
+}
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import struct
+import threading
+
+
+class BlockCache:
+    # Raw text blocks extracted from each PDF page, keyed by a hash of the page content, so that changing the
+    # filter configuration replays the blocks instead of parsing the PDF again
+    # Page record: (page number, content hash, number of blocks), followed by the blocks
+    page_record = struct.Struct("<I20sI")
+    # Block record: (x0, y0, x1, y1, block number, block type, text length in bytes), followed by the UTF-8 text
+    block_record = struct.Struct("<4dIII")
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        # page number -> (content hash, offset of the first block record)
+        self.pages = None
+        self.num_records = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def page_hash(page):
+        # Content stream and geometry of the page (much cheaper to read than laying out its text)
+        h = hashlib.sha1(page.read_contents())
+        h.update(f"{tuple(page.rect)} {page.rotation}".encode())
+        return h.digest()
+
+    def load(self):
+        self.pages = {}
+        self.num_records = 0
+        if not os.path.isfile(self.file_path):
+            return
+        with open(self.file_path, "rb") as f:
+            data = f.read()
+        pos = 0
+        # Append-only, the last record of a page wins
+        while pos + self.page_record.size <= len(data):
+            page_number, digest, num_blocks = self.page_record.unpack_from(data, pos)
+            offset = pos + self.page_record.size
+            end = self._skip_blocks(data, offset, num_blocks)
+            if end is None:
+                # Partially written last record
+                break
+            self.pages[page_number] = (digest, offset)
+            self.num_records += 1
+            pos = end
+
+    def _skip_blocks(self, data, pos, num_blocks):
+        for _ in range(num_blocks):
+            if pos + self.block_record.size > len(data):
+                return None
+            pos += self.block_record.size + self.block_record.unpack_from(data, pos)[-1]
+        return pos if pos <= len(data) else None
+
+    def get(self, page_number, digest):
+        # Blocks in the `extractBLOCKS()` format, or None if the page changed or was never extracted
+        with self.lock:
+            if self.pages is None:
+                self.load()
+            entry = self.pages.get(page_number)
+        if entry is None or entry[0] != digest:
+            return None
+        with open(self.file_path, "rb") as f:
+            f.seek(entry[1] - self.page_record.size)
+            _, _, num_blocks = self.page_record.unpack(f.read(self.page_record.size))
+            blocks = []
+            for _ in range(num_blocks):
+                x0, y0, x1, y1, block_no, block_type, size = self.block_record.unpack(
+                    f.read(self.block_record.size))
+                text = f.read(size).decode("utf-8", "surrogatepass")
+                blocks.append((x0, y0, x1, y1, text, block_no, block_type))
+        return blocks
+
+    def pack(self, page_number, digest, blocks):
+        buf = bytearray(self.page_record.pack(page_number, digest, len(blocks)))
+        for x0, y0, x1, y1, text, block_no, block_type in blocks:
+            text = text.encode("utf-8", "surrogatepass")
+            buf += self.block_record.pack(x0, y0, x1, y1, block_no, block_type, len(text)) + text
+        return buf
+
+    def put(self, page_number, digest, blocks):
+        buf = self.pack(page_number, digest, blocks)
+        with self.lock:
+            if self.pages is None:
+                self.load()
+            with open(self.file_path, "ab") as f:
+                offset = f.tell() + self.page_record.size
+                f.write(buf)
+            self.pages[page_number] = (digest, offset)
+            self.num_records += 1
+
+    def compact(self, num_pages):
+        # Drop the records of replaced pages and of pages past the end of the document
+        with self.lock:
+            if self.pages is None:
+                self.load()
+            live = {n: digest for n, (digest, _) in self.pages.items() if n < num_pages}
+            if self.num_records == len(live):
+                return
+        buf = bytearray()
+        pages = {}
+        for n, digest in sorted(live.items()):
+            pages[n] = (digest, len(buf) + self.page_record.size)
+            buf += self.pack(n, digest, self.get(n, digest))
+        with self.lock:
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(buf)
+            os.replace(tmp_path, self.file_path)
+            self.pages = pages
+            self.num_records = len(pages)
+
+    def clean(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+        self.pages = None
+        self.num_records = 0
@@ -0,0 +1,50 @@
+import os
+import shutil
+import subprocess
+
+from src.Wav import gen_wav, parse_wav
+
+# Storage codec -> (encoding byte recorded in the audio index, mimetype, ffmpeg output arguments)
+# LINEAR16 is stored as synthesized, the others are encoded with `ffmpeg` before being stored
+CODECS = {
+    'linear16': (0, 'audio/wav', None),
+    'flac': (1, 'audio/flac', ['-c:a', 'flac', '-compression_level', '8', '-f', 'flac']),
+    'opus': (2, 'audio/ogg', ['-c:a', 'libopus', '-b:a', '24k', '-application', 'voip', '-f', 'ogg']),
+}
+# Encoding byte -> storage codec
+ENCODINGS = {encoding: codec for codec, (encoding, _, _) in CODECS.items()}
+
+
+def get_storage_codec():
+    codec = os.environ.get('TTS_STORAGE_CODEC', 'linear16')
+    if codec not in CODECS:
+        raise Exception(f"Invalid TTS_STORAGE_CODEC `{codec}`, must be one of {sorted(CODECS)}")
+    if CODECS[codec][2] is not None and shutil.which("ffmpeg") is None:
+        raise Exception(f"TTS_STORAGE_CODEC={codec} requires `ffmpeg` to be installed")
+    return codec
+
+
+def ffmpeg(args, data):
+    return subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error"] + args,
+                          input=bytes(data), check=True, capture_output=True).stdout
+
+
+def encode(wav, codec):
+    # Returns (encoding, data) of a WAV blob stored with `codec`
+    encoding, _, args = CODECS[codec]
+    # Silent sentences have no samples to encode
+    if args is None or parse_wav(wav)[4] == 0:
+        return CODECS['linear16'][0], wav
+    return encoding, ffmpeg(["-f", "wav", "-i", "pipe:0"] + args + ["pipe:1"], wav)
+
+
+def decode(data, encoding, sample_rate, channels):
+    # WAV blob of stored audio, decoded back to 16-bit PCM at the configured rate
+    if ENCODINGS[encoding] == 'linear16':
+        return data
+    pcm = ffmpeg(["-i", "pipe:0", "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "pipe:1"], data)
+    return gen_wav(pcm, sample_rate, 16, channels)
+
+
+def mimetype(encoding):
+    return CODECS[ENCODINGS[encoding]][1]
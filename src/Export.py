@@ -0,0 +1,178 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+
+from src.Wav import gen_wav_header, parse_wav, wav_pcm
+
+# Format -> (mimetype, ffmpeg output arguments), WAV is written directly
+EXPORT_FORMATS = {
+    'wav': ('audio/wav', None),
+    'mp3': ('audio/mpeg', ['-c:a', 'libmp3lame', '-b:a', '64k', '-f', 'mp3']),
+    'ogg': ('audio/ogg', ['-c:a', 'libopus', '-b:a', '32k', '-f', 'ogg']),
+}
+CHUNK_SIZE = 64 * 1024
+PAGE_MARKER = "PAGE #"
+
+
+class AudioExporter:
+    # Concatenates the stored sentence segments of a document into one audio file, in constant memory
+
+    def __init__(self, store, callback, get_audio, decoded_fmt):
+        self.store = store
+        # Removes formatting tags from a sentence, used to label markers
+        self.callback = callback
+        # Decoded WAV audio of a sentence, for segments stored with a compressed codec
+        self.get_audio = get_audio
+        # (sample_rate, bits_per_sample, channels) of the audio returned by get_audio
+        self.decoded_fmt = decoded_fmt
+        self.fmt = None
+        self.segments = []
+        self.scan()
+
+    def scan(self):
+        # Locate the PCM data of every stored segment, only reading the segment headers
+        # (compressed segments have no data offset, they are decoded while writing)
+        self.segments = []
+        for i in range(len(self.store.text_list)):
+            length = self.store.length(i)
+            if length is None:
+                continue
+            if self.store.encoding(i) == self.store.ENCODING_LINEAR16:
+                header = self.store.read(i, 0, 256)
+                sample_rate, bits_per_sample, channels, data_offset, data_size = parse_wav(header, total_size=length)
+                fmt = (sample_rate, bits_per_sample, channels)
+            else:
+                fmt, data_offset, data_size = self.decoded_fmt, None, self.store.pcm_length(i)
+                if data_size is None:
+                    # Stored before the decoded length was recorded, decoded once here to know it
+                    data_size = len(wav_pcm(self.get_audio(i)))
+            if self.fmt is None:
+                self.fmt = fmt
+            elif fmt != self.fmt:
+                raise Exception(f"Sentence {i} has audio format {fmt}, expected {self.fmt}")
+            self.segments.append((i, data_offset, data_size))
+
+    def data_size(self):
+        return sum(size for _, _, size in self.segments)
+
+    def markers(self):
+        # (offset in sample frames, label) at every page marker sentence
+        if self.fmt is None:
+            return []
+        frame_bytes = self.fmt[1] // 8 * self.fmt[2]
+        markers = []
+        position = 0
+        for i, _, size in self.segments:
+            label = self.callback(self.store.text_list[i]).strip()
+            if label.startswith(PAGE_MARKER):
+                markers.append((position // frame_bytes, label))
+            position += size
+        return markers
+
+    @staticmethod
+    def cue_chunks(markers):
+        # `cue ` chunk with the marker positions and a LIST/adtl chunk with their labels
+        cue = struct.pack("<I", len(markers))
+        labels = b"adtl"
+        for n, (frame, label) in enumerate(markers, start=1):
+            cue += struct.pack("<II4sIII", n, frame, b"data", 0, 0, frame)
+            text = label.encode() + b"\0"
+            if len(text) % 2:
+                text += b"\0"
+            labels += b"labl" + struct.pack("<II", len(text) + 4, n) + text
+        return b"cue " + struct.pack("<I", len(cue)) + cue + b"LIST" + struct.pack("<I", len(labels)) + labels
+
+    def wav_size(self, markers=False):
+        if self.fmt is None:
+            # Nothing stored, `iter_wav()` yields nothing
+            return 0
+        data_size = self.data_size()
+        trailer = self.cue_chunks(self.markers()) if markers else b""
+        return 44 + data_size + (data_size & 1) + len(trailer)
+
+    def iter_wav(self, markers=False):
+        if self.fmt is None:
+            return
+        data_size = self.data_size()
+        trailer = self.cue_chunks(self.markers()) if markers else b""
+        header = bytearray(gen_wav_header(*self.fmt, datasize=data_size))
+        # RIFF size also covers the padding byte and the marker chunks after the data chunk
+        header[4:8] = (36 + data_size + (data_size & 1) + len(trailer)).to_bytes(4, 'little')
+        yield bytes(header)
+        for i, data_offset, size in self.segments:
+            # Stored WAV is read in place, compressed segments are decoded as a whole
+            if data_offset is None:
+                # Cut or padded to the recorded length, lossy codecs may decode to a few samples more or less
+                pcm = bytes(wav_pcm(self.get_audio(i))[:size])
+                pcm += b"\0" * (size - len(pcm))
+                for start in range(0, size, CHUNK_SIZE):
+                    yield pcm[start:start + CHUNK_SIZE]
+                continue
+            for start in range(data_offset, data_offset + size, CHUNK_SIZE):
+                yield self.store.read(i, start, min(start + CHUNK_SIZE, data_offset + size))
+        if data_size & 1:
+            yield b"\0"
+        yield trailer
+
+    def ffmetadata(self):
+        # Page markers as chapters, in the ffmpeg metadata file format
+        sample_rate = self.fmt[0]
+        total_ms = self.data_size() // (self.fmt[1] // 8 * self.fmt[2]) * 1000 // sample_rate
+        markers = self.markers()
+        lines = [";FFMETADATA1"]
+        for n, (frame, label) in enumerate(markers):
+            end = markers[n + 1][0] * 1000 // sample_rate if n + 1 < len(markers) else total_ms
+            lines += ["[CHAPTER]", "TIMEBASE=1/1000", f"START={frame * 1000 // sample_rate}", f"END={end}",
+                      f"title={label}"]
+        return "\n".join(lines) + "\n"
+
+    def iter_transcoded(self, fmt, markers=False):
+        if self.fmt is None:
+            return
+        args = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "wav", "-i", "pipe:0"]
+        metadata_path = None
+        if markers:
+            with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+                f.write(self.ffmetadata())
+                metadata_path = f.name
+            args += ["-i", metadata_path, "-map_metadata", "1", "-map_chapters", "1", "-map", "0:a"]
+        args += EXPORT_FORMATS[fmt][1] + ["pipe:1"]
+
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed():
+            try:
+                for chunk in self.iter_wav():
+                    proc.stdin.write(chunk)
+            except (BrokenPipeError, ValueError):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        try:
+            while True:
+                chunk = proc.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            proc.kill()
+            proc.wait()
+            writer.join()
+            if metadata_path is not None:
+                os.remove(metadata_path)
+
+    def iter_export(self, fmt='wav', markers=False):
+        if fmt == 'wav':
+            return self.iter_wav(markers=markers)
+        if shutil.which("ffmpeg") is None:
+            raise Exception(f"Exporting to {fmt} requires `ffmpeg` to be installed")
+        return self.iter_transcoded(fmt, markers=markers)
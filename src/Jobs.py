@@ -0,0 +1,182 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from src.PDFTextToSpeech import PDFTextToSpeech
+
+
+class JobManager:
+
+    def __init__(self, max_workers=2, extraction_workers=1):
+        ########################################################################
+        # Job Configuration
+        ########################################################################
+        # Number of documents processed at the same time
+        self.max_workers = max_workers
+        # Number of processes each job uses to extract PDF pages
+        self.extraction_workers = extraction_workers
+        ########################################################################
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="jobs")
+        # upload_id -> Future of the job running in this process
+        self.jobs = {}
+        # upload_id -> Future of the pre-render job (preparing an export) running in this process
+        self.renders = {}
+        self.lock = threading.Lock()
+
+    def submit(self, upload_id, pdf_file_path, on_done=None):
+        with self.lock:
+            job = self.jobs.get(upload_id)
+            if job is not None and not job.done():
+                return
+            # Held until the job ends, another process (e.g. web server worker) may be processing the document
+            job_lock = self.try_lock(PDFTextToSpeech.job_file_path(pdf_file_path))
+            if job_lock is None:
+                return
+            p = PDFTextToSpeech(pdf_file_path)
+            p.pdf_processor.num_workers = self.extraction_workers
+            self.save_status(p, {'status': 'queued', 'pages_done': 0, 'pages_total': None,
+                                 'blocks_done': 0, 'started': None, 'updated': time.time()})
+            self.jobs[upload_id] = self.executor.submit(self._run, upload_id, p, on_done, job_lock)
+
+    def _run(self, upload_id, p, on_done, job_lock):
+        with job_lock:
+            self._process(upload_id, p, on_done)
+
+    def _process(self, upload_id, p, on_done):
+        print(f"JOBS: Processing {upload_id}")
+        started = time.time()
+        status = {'status': 'running', 'pages_done': 0, 'pages_total': None, 'blocks_done': 0,
+                  'started': started, 'updated': started, 'resumed_from': None}
+
+        def progress(pages_done, pages_total, num_blocks):
+            if status['resumed_from'] is None:
+                status['resumed_from'] = pages_done - 1
+            status.update({'pages_done': pages_done, 'pages_total': pages_total,
+                           'blocks_done': status['blocks_done'] + num_blocks, 'updated': time.time()})
+            self.save_status(p, status)
+
+        try:
+            self.save_status(p, status)
+            p.process(progress=progress)
+            status.update({'status': 'done', 'updated': time.time()})
+        except Exception as e:
+            traceback.print_exc()
+            status.update({'status': 'failed', 'error': str(e), 'updated': time.time()})
+        self.save_status(p, status)
+        p.close()
+        if on_done is not None:
+            on_done(upload_id)
+
+    def submit_render(self, upload_id, pdf_file_path):
+        # Synthesizes every sentence without audio, so that the document can be exported
+        with self.lock:
+            job = self.renders.get(upload_id)
+            if job is not None and not job.done():
+                return
+            job_lock = self.try_lock(PDFTextToSpeech.job_file_path(pdf_file_path, "render"))
+            if job_lock is None:
+                return
+            p = PDFTextToSpeech(pdf_file_path)
+            self.save_status(p, {'status': 'queued', 'sentences_done': 0, 'sentences_total': None,
+                                 'started': None, 'updated': time.time()}, p.output_filepath_render)
+            self.renders[upload_id] = self.executor.submit(self._render, upload_id, p, job_lock)
+
+    def _render(self, upload_id, p, job_lock):
+        with job_lock:
+            self._prerender(upload_id, p)
+
+    def _prerender(self, upload_id, p):
+        print(f"JOBS: Rendering {upload_id}")
+        started = time.time()
+        status = {'status': 'running', 'sentences_done': 0, 'sentences_total': len(p.missing_audio()),
+                  'started': started, 'updated': started}
+
+        def progress(num_sentences):
+            status.update({'sentences_done': status['sentences_done'] + num_sentences, 'updated': time.time()})
+            self.save_status(p, status, p.output_filepath_render)
+
+        try:
+            self.save_status(p, status, p.output_filepath_render)
+            p.prerender(progress=progress)
+            status.update({'status': 'done', 'updated': time.time()})
+        except Exception as e:
+            traceback.print_exc()
+            status.update({'status': 'failed', 'error': str(e), 'updated': time.time()})
+        self.save_status(p, status, p.output_filepath_render)
+        p.close()
+
+    def status(self, upload_id, pdf_file_path):
+        status_path = PDFTextToSpeech.job_file_path(pdf_file_path)
+        p_status = self.load_status(status_path)
+        if p_status is None:
+            return None
+        self.mark_stale(p_status, self.jobs, upload_id, status_path)
+
+        # Estimate the remaining time from the pages processed in this run
+        p_status['eta_seconds'] = None
+        if p_status['status'] == 'running' and p_status['pages_total'] and p_status['resumed_from'] is not None:
+            pages_this_run = p_status['pages_done'] - p_status['resumed_from']
+            elapsed = p_status['updated'] - p_status['started']
+            if pages_this_run > 0:
+                p_status['eta_seconds'] = elapsed / pages_this_run * (p_status['pages_total'] - p_status['pages_done'])
+        return p_status
+
+    def render_status(self, upload_id, pdf_file_path):
+        status_path = PDFTextToSpeech.job_file_path(pdf_file_path, "render")
+        p_status = self.load_status(status_path)
+        if p_status is not None:
+            self.mark_stale(p_status, self.renders, upload_id, status_path)
+        return p_status
+
+    def mark_stale(self, p_status, jobs, upload_id, status_path):
+        with self.lock:
+            job = jobs.get(upload_id)
+            live = job is not None and not job.done()
+        if p_status['status'] not in ('queued', 'running') or live:
+            return
+        # The job lock is held by whichever process runs the job, if it can be taken that process is gone
+        job_lock = self.try_lock(status_path)
+        if job_lock is not None:
+            job_lock.close()
+            p_status['status'] = 'interrupted'
+
+    def is_running(self, upload_id, pdf_file_path):
+        # Running in this process or, judging by its status and job lock, in another one
+        p_status = self.status(upload_id, pdf_file_path)
+        return p_status is not None and p_status['status'] in ('queued', 'running')
+
+    @staticmethod
+    def try_lock(status_path):
+        # Exclusive lock of the job with this status file across processes, None if it is taken
+        # (released when the returned file is closed, or by the OS if the process dies)
+        f = open(f"{status_path}.lock", "ab")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    @staticmethod
+    def save_status(p, status, path=None):
+        path = path or p.output_filepath_job
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load_status(path):
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except Exception:
+            traceback.print_exc()
+            return None
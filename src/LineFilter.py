@@ -0,0 +1,96 @@
+import re
+import string
+
+# Character classes used to classify a line
+PUNCTUATION = 1
+DIGIT = 2
+PUNCTUATION_OR_DIGIT = 4
+ALL_CLASSES = PUNCTUATION | DIGIT | PUNCTUATION_OR_DIGIT
+
+
+class LineFilter:
+    # Compiled form of the PDFProcessor filter configuration, built once and applied to every paragraph
+
+    def __init__(self, config):
+        self.config = dict(config)
+
+        re_pattern = "[^a-zA]+" if config['skip_only_if_digits_inside'] else ".*?"
+        self.skip_patterns = []
+        if config['skip_parentheses']:
+            self.skip_patterns.append(re.compile(f"\\({re_pattern}\\)"))
+        if config['skip_brackets']:
+            self.skip_patterns.append(re.compile(f"\\[{re_pattern}\\]"))
+        if config['skip_braces']:
+            self.skip_patterns.append(re.compile(f"\\{{{re_pattern}\\}}"))
+
+        self.remove_symbols_and_digits_only_lines = config['remove_symbols_and_digits_only_lines']
+        self.remove_symbols_only_lines = config['remove_symbols_only_lines']
+        self.remove_digits_only_lines = config['remove_digits_only_lines']
+        self.remove_majority_non_ascii_lines = config['remove_majority_non_ascii_lines']
+        self.remove_majority_non_ascii_ratio = config['remove_majority_non_ascii_ratio']
+        self.remove_urls_only_lines = config['remove_urls_only_lines']
+
+        # Matches when the letters of a line start with "http" or "www", ignoring everything else
+        self.url_pattern = re.compile(r"[^a-zA-Z]*(?:h[^a-zA-Z]*t[^a-zA-Z]*t[^a-zA-Z]*p|w[^a-zA-Z]*w[^a-zA-Z]*w)")
+
+        # Character -> class bits, filled in lazily as new characters are seen
+        self.char_classes = {}
+
+    def char_class(self, c):
+        classes = self.char_classes.get(c)
+        if classes is None:
+            classes = 0
+            if c in string.punctuation:
+                classes |= PUNCTUATION
+            if c.isdigit():
+                classes |= DIGIT
+            if classes:
+                classes |= PUNCTUATION_OR_DIGIT
+            self.char_classes[c] = classes
+        return classes
+
+    def classify(self, ntxt):
+        # Classes shared by every character of the line (all of them for an empty line)
+        classes = ALL_CLASSES
+        for c in set(ntxt):
+            classes &= self.char_class(c)
+            if not classes:
+                break
+        return classes
+
+    def filter(self, text, removals):
+        ntxt = "".join(text.split())
+
+        for pattern in self.skip_patterns:
+            text = pattern.sub("", text)
+
+        classes = self.classify(ntxt)
+
+        if self.remove_symbols_and_digits_only_lines and classes & PUNCTUATION_OR_DIGIT:
+            removals['symbols_and_digits_only_lines'].append(text)
+            return None
+
+        if self.remove_symbols_only_lines and classes & PUNCTUATION:
+            removals['symbols_only_lines'].append(text)
+            return None
+
+        if self.remove_digits_only_lines and classes & DIGIT:
+            removals['digits_only_lines'].append(text)
+            return None
+
+        if self.remove_majority_non_ascii_lines and not ntxt.isascii():
+            # Get the number of non-ascii characters in the ntxt string
+            num_ascii = len(ntxt.encode("ascii", "ignore"))
+            num_total = len(ntxt)
+            if num_ascii / num_total < self.remove_majority_non_ascii_ratio:
+                removals['remove_majority_non_ascii_lines'].append(text)
+                return None
+
+        if self.remove_urls_only_lines and self.url_pattern.match(text):
+            removals['urls_only_lines'].append(text)
+            return None
+
+        return text
+
+    def filter_batch(self, paragraphs, removals):
+        return [self.filter(p, removals) for p in paragraphs]
@@ -0,0 +1,169 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Every metric defined in the process, in definition order, rendered by the /metrics endpoint
+REGISTRY = []
+
+# Upper bounds in seconds, from sub-millisecond filtering work up to slow API calls
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    # Label values are passed positionally, in the order of `labelnames`
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values -> value
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.format_labels(k), v) for k, v in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        # Computed when scraped instead of tracked, for values that are already known elsewhere
+        self.function = function
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    @contextmanager
+    def track(self, *labels):
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, "", self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # Counts per bucket (non-cumulative, the last one is +Inf), then the sum
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self):
+        # Observations across all label values
+        with self.lock:
+            return sum(sum(counts[:-1]) for counts in self.values.values())
+
+    def samples(self):
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+        samples = []
+        for k, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.format_labels(k, [("le", format_value(bound))]),
+                                cumulative))
+            samples.append((f"{self.name}_sum", self.format_labels(k), counts[-1]))
+            samples.append((f"{self.name}_count", self.format_labels(k), cumulative))
+        return samples
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render():
+    # Prometheus text exposition format
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+########################################################################
+# Metrics
+########################################################################
+PDF_PARSE_PAGE_SECONDS = Histogram("pdf_tts_pdf_parse_page_seconds",
+                                   "Time to extract and process the text of one PDF page")
+FILTER_PAGE_SECONDS = Histogram("pdf_tts_filter_page_seconds",
+                                "Time spent filtering the paragraphs of one PDF page")
+SENTENCE_SPLIT_SECONDS = Histogram("pdf_tts_sentence_split_seconds",
+                                   "Time to split one line of processed text into sentences")
+TTS_API_SECONDS = Histogram("pdf_tts_tts_api_seconds", "Latency of speech synthesis calls to the TTS backend",
+                            ["backend", "kind"])
+AUDIO_CACHE_IO_SECONDS = Histogram("pdf_tts_audio_cache_io_seconds",
+                                   "Time to read or write one entry of the shared audio cache", ["operation"])
+SERIALIZATION_SECONDS = Histogram("pdf_tts_serialization_seconds",
+                                  "Time to serialize or load document data", ["format", "operation"])
+AUDIO_LOOKUPS = Counter("pdf_tts_audio_lookups_total",
+                        "Sentence audio lookups by document, cache level (document store or shared cache) "
+                        "and result", ["document", "cache", "result"])
+INFLIGHT_SYNTHESES = Gauge("pdf_tts_inflight_syntheses", "Speech synthesis calls currently waiting on the backend")
+SCHEDULER_QUEUE_DEPTH = Gauge("pdf_tts_scheduler_queue_depth",
+                              "Speech synthesis calls waiting for their turn under the API quota", ["priority"])
+SCHEDULER_WAIT_SECONDS = Histogram("pdf_tts_scheduler_wait_seconds",
+                                   "Time a speech synthesis call waited under the API quota", ["priority"])
+SCHEDULER_RETRIES = Counter("pdf_tts_scheduler_retries_total",
+                            "Speech synthesis calls retried after a transient error", ["priority"])
+########################################################################
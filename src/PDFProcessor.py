@@ -1,9 +1,24 @@
 import argparse
+import json
+import multiprocessing
 import os
-import re
-import string
-from tqdm import tqdm
-import fitz
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from src.BlockCache import BlockCache
+from src.LineFilter import LineFilter
+from src.Metrics import FILTER_PAGE_SECONDS, PDF_PARSE_PAGE_SECONDS
+
+
+def process_page_range(pdf_file_path, config, start, stop):
+    # Runs in a worker process, with its own document handle
+    import fitz
+    processor = PDFProcessor(pdf_file_path)
+    for k, v in config.items():
+        setattr(processor, k, v)
+    doc = fitz.Document(pdf_file_path)
+    return [processor.process_page(doc[n]) for n in range(start, stop)]
 
 
 class PDFProcessor:
@@ -14,6 +29,10 @@ class PDFProcessor:
                                              os.path.basename(self.input_file_path).split('.')[0])
         self.output_file_path_txt_original = f"{output_file_path_base}_original.txt"
         self.output_file_path_txt_processed = f"{output_file_path_base}_processed.txt"
+        # Per-page results of an unfinished run, used to resume after a crash or restart
+        self.output_file_path_checkpoint = f"{output_file_path_base}_pages.jsonl"
+        # Raw text blocks of every page, replayed when only the filter configuration changes
+        self.block_cache = BlockCache(f"{output_file_path_base}_blocks.bin")
         ########################################################################
         # PDF Processing Configuration
         ########################################################################
@@ -37,103 +56,197 @@ class PDFProcessor:
         self.remove_digits_only_lines = True
         self.remove_urls_only_lines = True
         ########################################################################
+        # Number of worker processes used to extract pages (1 processes pages serially)
+        self.num_workers = 1
+        # Number of consecutive pages handed to a worker at a time
+        self.pages_per_shard = 16
+        # Write the `_original.txt` and `_processed.txt` exports once all pages are processed
+        self.export_txt = True
+        ########################################################################
 
         self.removals = {'remove_majority_non_ascii_lines': [],
                          'symbols_and_digits_only_lines': [],
                          'symbols_only_lines': [],
                          'digits_only_lines': [],
                          'urls_only_lines': []}
-
-    def filter(self, text):
-        # text = text.strip()
-        ntxt = re.sub(r"\s+", "", text)
-
-        re_pattern = "[^a-zA]+" if self.skip_only_if_digits_inside else ".*?"
-
-        if self.skip_parentheses:
-            text = re.sub(f"\({re_pattern}\)", "", text)
-        if self.skip_brackets:
-            text = re.sub(f"\[{re_pattern}\]", "", text)
-        if self.skip_braces:
-            text = re.sub(f"\{{{re_pattern}\}}", "", text)
-
-        if self.remove_symbols_and_digits_only_lines and all((i in string.punctuation or i.isdigit()) for i in ntxt):
-            self.removals['symbols_and_digits_only_lines'].append(text)
-            return None
-
-        if self.remove_symbols_only_lines and all(i in string.punctuation for i in ntxt):
-            self.removals['symbols_only_lines'].append(text)
-            return None
-
-        if self.remove_digits_only_lines and all(i.isdigit() for i in ntxt):
-            self.removals['digits_only_lines'].append(text)
-            return None
-
-        if self.remove_majority_non_ascii_lines:
-            # Get the number of non-ascii characters in the ntxt string
-            num_ascii = len(ntxt.encode("ascii", "ignore"))
-            num_total = len(ntxt)
-            if num_ascii / num_total < self.remove_majority_non_ascii_ratio:
-                self.removals['remove_majority_non_ascii_lines'].append(text)
-                return None
-
-        if self.remove_urls_only_lines:
-            # remove all digits, symbols, and whitespace
-            ntxt = re.sub("[^a-zA-Z]", "", text)
-            if (ntxt.startswith("http") or
-                    ntxt.startswith("www")):
-                self.removals['urls_only_lines'].append(text)
-                return None
-
-        return text
-
-    def process(self):
-        text_list = []
+        self._line_filter = None
+
+    def line_filter(self):
+        # Rebuilt only when the filter configuration changed since the last call
+        config = self.config()
+        if self._line_filter is None or self._line_filter.config != config:
+            self._line_filter = LineFilter(config)
+        return self._line_filter
+
+    def filter(self, text, removals=None):
+        removals = self.removals if removals is None else removals
+        return self.line_filter().filter(text, removals)
+
+    def config(self):
+        return {k: v for k, v in vars(self).items() if k.startswith(('skip_', 'remove_'))}
+
+    def process_page(self, page):
+        start = time.perf_counter()
+        filter_seconds = 0
+        removals = {k: [] for k in self.removals}
+        label = page.get_label()
+        label = f' ({label})' if label != '' else ''
+        buf_page_num = f"\n<CENTER><UNDERLINE><BOLD>PAGE #{page.number + 1}{label}<BOLD><UNDERLINE><CENTER>\n\n"
+        text_list = [buf_page_num]
+        original = []
+        line_filter = self.line_filter()
+        digest = BlockCache.page_hash(page)
+        blocks = self.block_cache.get(page.number, digest)
+        extracted = blocks is None
+        if extracted:
+            blocks = page.get_textpage().extractBLOCKS()
+
+        for b in blocks:
+            txt = b[4]
+            # txt = txt.strip()
+            txt = txt.replace("\n ", "\n")
+            original.append(txt)
+            original.append("-" * 80 + "\n")
+
+            sections = txt.split("\n\n")
+            paragraphs = []
+            for s in sections:
+                #################
+                # MODE 1
+                #################
+                txt_split = s.split("\n")
+                paragraphs.append(" ".join(txt_split))
+
+            filter_start = time.perf_counter()
+            filtered = line_filter.filter_batch(paragraphs, removals)
+            filter_seconds += time.perf_counter() - filter_start
+            for txt in filtered:
+                if txt is not None:
+                    txt = txt + "\n\n"
+                    txt = txt.replace("  ", " ")
+                    txt = txt.replace("- ", "-")
+                    txt = txt.replace(" -", "-")
+                    txt = txt.replace(" , ", ", ")
+                    txt = txt.replace(" .", ".")
+                    text_list.append(txt)
+
+        result = {'page': page.number,
+                  'original': "".join(original),
+                  'text_list': text_list,
+                  'removals': removals,
+                  'num_blocks': len(blocks),
+                  # Timings travel with the result, pages may be processed in another process
+                  'seconds': {'parse': time.perf_counter() - start, 'filter': filter_seconds}}
+        if extracted:
+            # Added to the block cache by the parent process, which is its only writer
+            result['blocks'] = (digest, blocks)
+        return result
+
+    def resume_checkpoint(self):
+        # Returns the number of pages finished by an earlier run, dropping anything unusable
+        if not os.path.isfile(self.output_file_path_checkpoint):
+            return 0
+        num_pages = 0
+        with open(self.output_file_path_checkpoint, "rb") as f:
+            header = f.readline()
+            # First line records the configuration the pages were processed with
+            if not header.endswith(b"\n") or json.loads(header) != self.config():
+                f.close()
+                os.remove(self.output_file_path_checkpoint)
+                return 0
+            valid_end = f.tell()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Partially written last page, it will be processed again
+                    break
+                num_pages += 1
+                valid_end = f.tell()
+        os.truncate(self.output_file_path_checkpoint, valid_end)
+        if num_pages:
+            print(f"CHECKPOINT: Resuming after {num_pages} pages")
+        return num_pages
+
+    def iter_checkpoint(self):
+        if not os.path.isfile(self.output_file_path_checkpoint):
+            return
+        with open(self.output_file_path_checkpoint, "r") as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+
+    def iter_page_results(self, doc, start_page):
+        num_pages = len(doc)
+        if self.num_workers <= 1 or num_pages - start_page <= self.pages_per_shard:
+            for n in range(start_page, num_pages):
+                yield self.process_page(doc[n])
+            return
+
+        starts = range(start_page, num_pages, self.pages_per_shard)
+        stops = [min(n + self.pages_per_shard, num_pages) for n in starts]
+        with ProcessPoolExecutor(max_workers=self.num_workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            # map() yields shards in submission order, so pages are merged in page order
+            for results in executor.map(process_page_range, repeat(self.input_file_path),
+                                        repeat(self.config()), starts, stops):
+                yield from results
+
+    def iter_text(self, progress=None):
+        # Lazily yields the processed text items page by page, checkpointing each finished page
+        # (PyMuPDF and tqdm are only imported once a document is actually processed)
+        import fitz
+        from tqdm import tqdm
+        for removed in self.removals.values():
+            removed.clear()
+        num_done = self.resume_checkpoint()
         doc = fitz.Document(self.input_file_path)
 
-        page: fitz.Page
+        for result in self.iter_checkpoint():
+            yield from self._consume(result)
+
+        with open(self.output_file_path_checkpoint, "a") as cp:
+            if num_done == 0:
+                cp.write(json.dumps(self.config()) + "\n")
+            for result in tqdm(self.iter_page_results(doc, num_done), initial=num_done, total=len(doc)):
+                if 'blocks' in result:
+                    digest, blocks = result.pop('blocks')
+                    self.block_cache.put(result['page'], digest, blocks)
+                cp.write(json.dumps(result) + "\n")
+                cp.flush()
+                num_done += 1
+                PDF_PARSE_PAGE_SECONDS.observe(result['seconds']['parse'])
+                FILTER_PAGE_SECONDS.observe(result['seconds']['filter'])
+                if progress is not None:
+                    progress(num_done, len(doc), result['num_blocks'])
+                yield from self._consume(result)
+
+        if self.export_txt:
+            self.export()
+        self.block_cache.compact(len(doc))
+        os.remove(self.output_file_path_checkpoint)
+
+    def _consume(self, result):
+        for k, removed in result['removals'].items():
+            self.removals[k].extend(removed)
+        return result['text_list']
+
+    def export(self):
         with open(self.output_file_path_txt_original, "w") as f:
-            for page in tqdm(doc):
-                label = page.get_label()
-                label = f' ({label})' if label != '' else ''
-                buf_page_num = f"\n<CENTER><UNDERLINE><BOLD>PAGE #{page.number + 1}{label}<BOLD><UNDERLINE><CENTER>\n\n"
-                text_list.append(buf_page_num)
-                page = page.get_textpage()
-                blocks = page.extractBLOCKS()
-
-                for b in blocks:
-                    txt = b[4]
-                    # txt = txt.strip()
-                    txt = txt.replace("\n ", "\n")
-                    f.write(txt)
-                    f.write("-" * 80 + "\n")
-
-                    sections = txt.split("\n\n")
-                    paragraphs = []
-                    for s in sections:
-                        #################
-                        # MODE 1
-                        #################
-                        txt_split = s.split("\n")
-                        paragraphs.append(" ".join(txt_split))
-
-                    for p in paragraphs:
-                        txt = self.filter(p)
-                        if txt is not None:
-                            txt = txt + "\n\n"
-                            txt = txt.replace("  ", " ")
-                            txt = txt.replace("- ", "-")
-                            txt = txt.replace(" -", "-")
-                            txt = txt.replace(" , ", ", ")
-                            txt = txt.replace(" .", ".")
-                            text_list.append(txt)
+            for result in self.iter_checkpoint():
+                f.write(result['original'])
 
         with open(self.output_file_path_txt_processed, "w") as f:
-            for item in text_list:
-                f.write(item)
-            # f.write(text)
+            for result in self.iter_checkpoint():
+                for item in result['text_list']:
+                    f.write(item)
+
+    def process(self, progress=None):
+        for _ in self.iter_text(progress=progress):
+            pass
 
     def clean(self):
+        self.block_cache.clean()
+        if os.path.exists(self.output_file_path_checkpoint):
+            os.remove(self.output_file_path_checkpoint)
         if os.path.exists(self.output_file_path_txt_processed):
             os.remove(self.output_file_path_txt_processed)
         if os.path.exists(self.output_file_path_txt_original):
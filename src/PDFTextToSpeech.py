@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 import traceback
 # import simpleaudio as sa
 
@@ -8,8 +10,12 @@ import traceback
 
 # # Setting up configuration
 # filename = "./pdf-sample.pdf"
+from src.Export import AudioExporter, EXPORT_FORMATS
+from src.Metrics import SERIALIZATION_SECONDS
 from src.PDFProcessor import PDFProcessor
+from src.Scheduler import INTERACTIVE, READ_AHEAD
 from src.TTS import TextToSpeech
+from src.Wav import wav_pcm
 
 
 class PDFTextToSpeech:
@@ -19,58 +25,167 @@ class PDFTextToSpeech:
         output_file_path_base = os.path.join(os.path.dirname(self.input_file_path),
                                              os.path.basename(self.input_file_path).split('.')[0])
         self.output_filepath_json = f"{output_file_path_base}.json"
+        self.output_filepath_job = self.job_file_path(self.input_file_path)
+        # Status of the background pre-render job that prepares an export
+        self.output_filepath_render = self.job_file_path(self.input_file_path, "render")
 
         self.formatting = ["BOLD", "ITALIC",
                            "UNDERLINE", "STRIKETHROUGH", "CENTER"]
 
         self.pdf_processor = PDFProcessor(self.input_file_path)
         self.tts = TextToSpeech(self.pdf_processor.output_file_path_txt_processed)
+        # Contents of the `.json` file and its modification time when loaded, see `get_data()`
+        self.data = None
+        self.data_mtime = None
 
     def get_data(self):
-        data = self.load_data()
+        # Document metadata for a page view, the sentences themselves are served in windows by `get_text()`
+        # (read only: `process()`, possibly in another process, is the only writer of the `.json` file)
+        self.tts.store.refresh()
+        try:
+            mtime = os.stat(self.output_filepath_json).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self.data is None or mtime != self.data_mtime:
+            self.data = self.load_data()
+            self.data_mtime = mtime
 
         text_list = self.tts.text_list()
-        num_seqs_cached = self.tts.num_seqs_cached()
-
+        data = {'info': dict(self.data['info'])}
+        # Derived from the store on every view, kept up to date as sentences and audio are stored
         data['info'].update({'file_name': os.path.basename(self.input_file_path),
                              'num_seqs': None if text_list is None else len(text_list),
-                             'num_seqs_cached': num_seqs_cached,
-                             'is_processed': self.tts.text_audio_map is not None})
-
-        data.update({
-            'text_list': text_list,
-            'removals': self.pdf_processor.removals,
-        })
-
-        print(f"DATA: Saving {self.output_filepath_json}")
-        with open(self.output_filepath_json, "w") as f:
-            json.dump(data, f, indent=4)
+                             'is_processed': self.tts.store.exists(),
+                             'num_seqs_cached': self.tts.num_seqs_cached()})
         return data
 
+    def get_text(self, start, count):
+        self.tts.store.refresh()
+        text_list = self.tts.text_list() or []
+        return {'start': start, 'num_seqs': len(text_list), 'text_list': text_list[start:start + count]}
+
     def load_data(self):
-        print(f"DATA: Loading {self.output_filepath_json} "
-              f"[Exists={os.path.isfile(self.output_filepath_json)}]")
         data = {'info': {}}
         if os.path.isfile(self.output_filepath_json):
             try:
-                with open(self.output_filepath_json, "r") as f:
+                with SERIALIZATION_SECONDS.time("json", "load"), open(self.output_filepath_json, "r") as f:
                     data = json.load(f)
             except Exception:
                 traceback.print_exc()
+        # Sentences used to be saved along with the metadata, and store counts before they were derived from it
+        data.pop('text_list', None)
+        for key in ('num_seqs', 'is_processed'):
+            data['info'].pop(key, None)
         return data
 
-    def process(self):
-        print(f"PROCESSING")
-        self.pdf_processor.process()
-        self.tts.process()
+    def save_data(self):
+        # Unique per writer process and thread
+        tmp_path = f"{self.output_filepath_json}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with SERIALIZATION_SECONDS.time("json", "dump"), open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.output_filepath_json)
 
-    def stream_index(self, index):
-        def remove_formatting(text):
-            for f in self.formatting:
-                text = text.replace(f"<{f}>", "")
-            return text
+    @staticmethod
+    def job_file_path(pdf_file_path, name="job"):
+        output_file_path_base = os.path.join(os.path.dirname(pdf_file_path),
+                                             os.path.basename(pdf_file_path).split('.')[0])
+        return f"{output_file_path_base}.{name}.json"
 
-        return self.tts.stream_index(index, remove_formatting)
+    def process(self, progress=None):
+        print(f"PROCESSING")
+        # Sentences are split and stored page by page as the PDF is parsed
+        self.tts.process(self.pdf_processor.iter_text(progress=progress), self.remove_formatting)
+
+        # Read-modify-write, keeping whatever another process wrote in the meantime
+        with self.tts.store.write_lock():
+            self.data = self.load_data()
+            self.data['info']['last_processed'] = time.strftime("%Y-%m-%d %H:%M:%S")
+            self.data['removals'] = self.pdf_processor.removals
+            self.save_data()
+            self.data_mtime = os.stat(self.output_filepath_json).st_mtime_ns
+
+    def remove_formatting(self, text):
+        for f in self.formatting:
+            text = text.replace(f"<{f}>", "")
+        return text
+
+    def prerender(self, indices=None, progress=None):
+        self.tts.prerender(self.remove_formatting, indices=indices, progress=progress)
+
+    def missing_audio(self):
+        # Sentences still to synthesize before the document can be exported
+        return self.tts.missing(self.remove_formatting)
+
+    def export(self, fmt='wav', markers=False):
+        # Returns (chunk iterator, mimetype, size in bytes or None) of the whole document as one audio file,
+        # from the stored audio only (see `missing_audio()`, the pre-render runs as a job)
+        exporter = AudioExporter(self.tts.store, self.remove_formatting, self.tts.get_audio,
+                                 (self.tts.audio_sample_rate, 16, self.tts.audio_channels))
+        size = exporter.wav_size(markers=markers) if fmt == 'wav' else None
+        return exporter.iter_export(fmt, markers=markers), EXPORT_FORMATS[fmt][0], size
+
+    def stream_index(self, index, priority=INTERACTIVE):
+        return self.tts.stream_index(index, self.remove_formatting, priority)
+
+    def stream_audio(self, index, accept=None):
+        return self.tts.stream_audio(index, self.remove_formatting, accept=accept)
+
+    async def stream_audio_async(self, index, accept=None):
+        return await self.tts.stream_audio_async(index, self.remove_formatting, accept=accept)
+
+    def num_sentences(self):
+        self.tts.store.refresh()
+        return len(self.tts.store.text_list) if self.tts.store.exists() else None
+
+    def etag(self, index):
+        # Identifies the audio of a sentence by its text and voice configuration
+        self.tts.store.refresh()
+        text = self.remove_formatting(self.tts.store.text_list[index])
+        return self.tts.cache.key(text, self.tts.voice_config())
+
+    def stream_from(self, index):
+        # One WAV stream of every sentence from `index` on, its sentence boundaries are given by `timeline(index)`
+        def generate():
+            # Header with a placeholder size, the stream length is not known up front
+            yield self.tts.wav_header
+            first = True
+            for i in range(index, len(self.tts.store.text_list)):
+                if not self.remove_formatting(self.tts.store.text_list[i]).strip():
+                    continue
+                # Only the first sentence keeps the listener waiting, the rest is buffered ahead of playback
+                pcm = bytes(wav_pcm(self.stream_index(i, INTERACTIVE if first else READ_AHEAD)))
+                first = False
+                length = self.tts.pcm_length(i)
+                if length is not None:
+                    # The length `timeline()` counts, lossy codecs may decode to a few samples more or less
+                    pcm = pcm[:length] + b"\0" * (length - len(pcm))
+                yield pcm
+
+        return generate()
+
+    def timeline(self, index):
+        # Start time of each sentence of the stream from `index`, as far as its audio is stored
+        # (derived from the store alone, any worker can answer for a stream served by another)
+        self.tts.store.refresh()
+        bytes_per_second = self.tts.audio_sample_rate * self.tts.audio_channels * self.tts.audio_bits_per_sample // 8
+        timeline = []
+        position = 0
+        for i in range(index, len(self.tts.store.text_list)):
+            if not self.remove_formatting(self.tts.store.text_list[i]).strip():
+                continue
+            length = self.tts.pcm_length(i)
+            if length is None:
+                break
+            timeline.append({'index': i, 'start': position / bytes_per_second})
+            position += length
+        return timeline
+
+    def close(self):
+        self.tts.close()
+
+    def memory_usage(self):
+        return self.tts.memory_usage() + sum(len(text) for removed in self.pdf_processor.removals.values()
+                                             for text in removed)
 
     def clean(self):
         print("CLEAN")
@@ -79,3 +194,7 @@ class PDFTextToSpeech:
 
         if os.path.exists(self.output_filepath_json):
             os.remove(self.output_filepath_json)
+        self.data = None
+        for path in (self.output_filepath_job, self.output_filepath_render):
+            if os.path.exists(path):
+                os.remove(path)
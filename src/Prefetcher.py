@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Bounded worker pool shared by all documents for read-ahead synthesis
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(max_workers=4):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        return _executor
+
+
+class Prefetcher:
+
+    def __init__(self, read_ahead=3):
+        # Number of sentences after the one being listened to that are synthesized in the background
+        self.read_ahead = read_ahead
+
+        # index -> Future of the synthesis currently running for that index
+        self.in_flight = {}
+        # index -> executor Future of a queued read-ahead job
+        self.scheduled = {}
+        # Tasks of syntheses started by `fetch_async()`, referenced until they finish
+        self.tasks = set()
+        # Index most recently requested by the listener
+        self.position = None
+        self.lock = threading.Lock()
+
+    def fetch(self, index, fn):
+        # Run fn(index) once, any concurrent caller for the same index waits for that result
+        with self.lock:
+            future = self.in_flight.get(index)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[index] = future
+        if not owner:
+            return future.result()
+
+        try:
+            result = fn(index)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(index, None)
+
+    async def fetch_async(self, index, fn):
+        # `fetch()` for a coroutine function, sharing in-flight syntheses with the worker threads
+        # (a listener disconnecting does not cancel a synthesis others may be waiting for)
+        with self.lock:
+            future = self.in_flight.get(index)
+            if future is None:
+                future = Future()
+                self.in_flight[index] = future
+                task = asyncio.ensure_future(self._fetch_async(index, fn, future))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def _fetch_async(self, index, fn, future):
+        try:
+            future.set_result(await fn(index))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.in_flight.pop(index, None)
+
+    def schedule(self, index, candidates, fn):
+        with self.lock:
+            self.position = index
+            # Drop queued jobs the listener has moved away from
+            for j, job in list(self.scheduled.items()):
+                if j not in candidates and job.cancel():
+                    del self.scheduled[j]
+            for j in candidates:
+                if j in self.scheduled or j in self.in_flight:
+                    continue
+                self.scheduled[j] = get_executor().submit(self._read_ahead, j, fn)
+
+    def _read_ahead(self, index, fn):
+        try:
+            with self.lock:
+                stale = self.position is None or not (self.position < index <= self.position + self.read_ahead)
+            if not stale:
+                self.fetch(index, fn)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.scheduled.pop(index, None)
+
+    def cancel(self):
+        with self.lock:
+            self.position = None
+            for job in self.scheduled.values():
+                job.cancel()
+            self.scheduled.clear()
@@ -0,0 +1,201 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+from src.Backends import get_backend
+from src.Metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_RETRIES, SCHEDULER_WAIT_SECONDS
+
+# Priority classes of synthesis calls, lowest value first
+INTERACTIVE = 0
+READ_AHEAD = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", READ_AHEAD: "read_ahead", BULK: "bulk"}
+
+# Scheduler shared by all documents in the process, all of them count against the same API quota
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(requests_per_minute=int(os.environ.get('TTS_REQUESTS_PER_MINUTE', 1000)),
+                                   chars_per_minute=int(os.environ.get('TTS_CHARS_PER_MINUTE', 150000)),
+                                   max_retries=int(os.environ.get('TTS_MAX_RETRIES', 5)))
+        return _scheduler
+
+
+class TokenBucket:
+    # Refills continuously at `per_minute`, holding at most `burst_seconds` worth of tokens (0 means unlimited)
+
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        # Seconds until `amount` tokens are available (a call larger than the bucket only needs it full)
+        if self.rate == 0:
+            return 0
+        self.refill(now)
+        return max(0, min(amount, self.capacity) - self.tokens) / self.rate
+
+    def take(self, amount):
+        if self.rate != 0:
+            self.tokens -= amount
+
+
+class Scheduler:
+    # Admits synthesis calls one at a time within the request and character quotas, highest priority first,
+    # and retries transient errors with jittered exponential backoff
+
+    def __init__(self, requests_per_minute=1000, chars_per_minute=150000, max_retries=5):
+        ########################################################################
+        # Scheduler Configuration
+        ########################################################################
+        # API quotas (the Google defaults), 0 disables a limit
+        self.requests = TokenBucket(requests_per_minute)
+        self.chars = TokenBucket(chars_per_minute)
+        # Attempts after the first one failed with a transient error
+        self.max_retries = max_retries
+        # Backoff before retry n is random between 0 and min(backoff_max, backoff_base * 2^n) seconds
+        self.backoff_base = 0.5
+        self.backoff_max = 30
+        ########################################################################
+
+        # Heap of waiting tickets: [priority, sequence number, key, time enqueued, (loop, event) of an asyncio call]
+        # Threads wait on the condition, an asyncio call on its event, set once its ticket reaches the head
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def call(self, fn, priority, chars, key=None):
+        # Runs fn() (one API call of `chars` characters) once admitted, `key` identifies the sentence for `promote()`
+        for attempt in itertools.count():
+            self.acquire(priority, chars, key)
+            try:
+                return fn()
+            except Exception as e:
+                if not self.retry(e, priority, attempt):
+                    raise
+            time.sleep(self.backoff(attempt))
+
+    async def call_async(self, fn, priority, chars, key=None):
+        # `call()` for a coroutine function, waiting without blocking the event loop
+        for attempt in itertools.count():
+            await self.acquire_async(priority, chars, key)
+            try:
+                return await fn()
+            except Exception as e:
+                if not self.retry(e, priority, attempt):
+                    raise
+            await asyncio.sleep(self.backoff(attempt))
+
+    def retry(self, e, priority, attempt):
+        if attempt >= self.max_retries or not get_backend().is_retryable(e):
+            return False
+        print(f"SCHEDULER: Retrying after {e!r}")
+        SCHEDULER_RETRIES.inc(PRIORITY_NAMES[priority])
+        return True
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def acquire(self, priority, chars, key=None):
+        with self.condition:
+            ticket = self._enqueue(priority, key)
+            try:
+                while True:
+                    delay = self._try_take(ticket, chars)
+                    if delay == 0:
+                        return
+                    self.condition.wait(delay)
+            finally:
+                self._dequeue(ticket)
+
+    async def acquire_async(self, priority, chars, key=None):
+        event = asyncio.Event()
+        with self.condition:
+            ticket = self._enqueue(priority, key, (asyncio.get_running_loop(), event))
+        try:
+            while True:
+                # Cleared before checking, so a wake-up after the check is not lost
+                event.clear()
+                with self.condition:
+                    delay = self._try_take(ticket, chars)
+                if delay == 0:
+                    return
+                try:
+                    # Until its turn, or at the head of the queue until its tokens are available
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self._dequeue(ticket)
+
+    def promote(self, key, priority):
+        # Raises the priority of a waiting call, e.g. a read-ahead of the sentence a listener now waits on
+        with self.condition:
+            changed = False
+            for ticket in self.waiting:
+                if ticket[2] == key and ticket[0] > priority:
+                    SCHEDULER_QUEUE_DEPTH.dec(PRIORITY_NAMES[ticket[0]])
+                    SCHEDULER_QUEUE_DEPTH.inc(PRIORITY_NAMES[priority])
+                    ticket[0] = priority
+                    changed = True
+            if changed:
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+                self._wake_head()
+
+    def _enqueue(self, priority, key, waker=None):
+        ticket = [priority, next(self.sequence), key, time.monotonic(), waker]
+        heapq.heappush(self.waiting, ticket)
+        SCHEDULER_QUEUE_DEPTH.inc(PRIORITY_NAMES[priority])
+        return ticket
+
+    def _dequeue(self, ticket):
+        SCHEDULER_QUEUE_DEPTH.dec(PRIORITY_NAMES[ticket[0]])
+        self.waiting.remove(ticket)
+        heapq.heapify(self.waiting)
+        self.condition.notify_all()
+        self._wake_head()
+
+    def _wake_head(self):
+        # Lets the asyncio call now at the head of the queue check its turn (from any thread)
+        if self.waiting and self.waiting[0][4] is not None:
+            loop, event = self.waiting[0][4]
+            loop.call_soon_threadsafe(event.set)
+
+    def _try_take(self, ticket, chars):
+        # 0 once the ticket is admitted, else the seconds until its tokens are available (None if not its turn)
+        if self.waiting[0] is not ticket:
+            return None
+        now = time.monotonic()
+        delay = max(self.requests.delay(1, now), self.chars.delay(chars, now))
+        if delay > 0:
+            return delay
+        self.requests.take(1)
+        self.chars.take(chars)
+        SCHEDULER_WAIT_SECONDS.observe(now - ticket[3], PRIORITY_NAMES[ticket[0]])
+        return 0
+
+    def stats(self):
+        with self.condition:
+            queued = [ticket[0] for ticket in self.waiting]
+        with SCHEDULER_WAIT_SECONDS.lock:
+            waits = {labels[0]: (sum(counts[:-1]), counts[-1])
+                     for labels, counts in SCHEDULER_WAIT_SECONDS.values.items()}
+        return {'queue_depth': {name: queued.count(p) for p, name in PRIORITY_NAMES.items()},
+                'mean_wait_seconds': {name: total / count for name, (count, total) in waits.items() if count}}
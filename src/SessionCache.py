@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+from src.PDFTextToSpeech import PDFTextToSpeech
+
+
+class SessionCache:
+
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024, max_idle_seconds=30 * 60):
+        ########################################################################
+        # Session Cache Configuration
+        ########################################################################
+        # Approximate memory budget for all live documents combined
+        self.max_memory_bytes = max_memory_bytes
+        # Documents not accessed for this long are dropped
+        self.max_idle_seconds = max_idle_seconds
+        ########################################################################
+
+        # upload_id -> (PDFTextToSpeech, last access time), least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, upload_id, pdf_file_path):
+        with self.lock:
+            self.evict_idle()
+            entry = self.sessions.get(upload_id)
+            if entry is not None and entry[0].input_file_path == pdf_file_path:
+                self.sessions[upload_id] = (entry[0], time.monotonic())
+                self.sessions.move_to_end(upload_id)
+                return entry[0]
+
+            print(f"SESSIONS: Opening {upload_id}")
+            p = PDFTextToSpeech(pdf_file_path)
+            self.sessions[upload_id] = (p, time.monotonic())
+            self.evict_over_budget()
+            return p
+
+    def invalidate(self, upload_id):
+        with self.lock:
+            entry = self.sessions.pop(upload_id, None)
+            if entry is not None:
+                print(f"SESSIONS: Invalidating {upload_id}")
+                entry[0].close()
+
+    def memory_usage(self):
+        # Snapshot for readers outside the cache (e.g. the metrics gauge), sessions change under the lock
+        with self.lock:
+            return self._memory_usage()
+
+    def _memory_usage(self):
+        # Caller holds the lock
+        return sum(p.memory_usage() for p, _ in self.sessions.values())
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for upload_id, (p, last_used) in list(self.sessions.items()):
+            if now - last_used > self.max_idle_seconds:
+                print(f"SESSIONS: Evicting idle {upload_id}")
+                del self.sessions[upload_id]
+                p.close()
+
+    def evict_over_budget(self):
+        # Always keep the most recently used document, even if it alone exceeds the budget
+        while len(self.sessions) > 1 and self._memory_usage() > self.max_memory_bytes:
+            upload_id, (p, _) = self.sessions.popitem(last=False)
+            print(f"SESSIONS: Evicting {upload_id} (over memory budget)")
+            p.close()
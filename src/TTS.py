@@ -1,9 +1,18 @@
+import asyncio
 import io
 import os
-import pickle
-import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
 
-from google.cloud import texttospeech
+from src.AudioCache import get_cache
+from src.AudioStore import AudioStore
+from src.Backends import backend_class, get_backend
+from src.Codecs import decode, encode, get_storage_codec, mimetype
+from src.Metrics import AUDIO_LOOKUPS, INFLIGHT_SYNTHESES, SENTENCE_SPLIT_SECONDS, TTS_API_SECONDS
+from src.Prefetcher import Prefetcher
+from src.Scheduler import BULK, INTERACTIVE, READ_AHEAD, get_scheduler
+from src.Wav import gen_wav_header, parse_wav, wav_pcm
 
 
 class TextToSpeech:
@@ -12,9 +21,11 @@ class TextToSpeech:
         self.input_file_path = txt_file_path
         output_filepath = os.path.join(os.path.dirname(self.input_file_path),
                                        os.path.basename(self.input_file_path).split('.')[0])
-        self.output_filepath_seqs = f"{output_filepath}.seqs"
+        self.store = AudioStore(output_filepath)
+        # Documents live in their own upload directory, named after the upload_id
+        self.document = os.path.basename(os.path.dirname(os.path.abspath(self.input_file_path)))
         ########################################################################
-        # Google TTS Configuration
+        # TTS Configuration (the backend itself is selected with TTS_BACKEND)
         ########################################################################
         # Change the speaking rate for Google TTS (Default: 1)
         # (This usually does not need to be changed as it is controlled afterwards through the Web interface)
@@ -23,6 +34,14 @@ class TextToSpeech:
         self.pitch = 0.0
         # Change language code for Google TTS (Default: en-US)
         self.language_code = "en-US"
+        # Number of upcoming sentences synthesized in the background while streaming
+        self.read_ahead = 3
+        # Pack consecutive sentences into one API call when pre-rendering a whole document
+        self.batch_synthesis = True
+        # Maximum size of one batched SSML request (the API limit is 5000 bytes)
+        self.batch_max_bytes = 4500
+        # Number of API calls made at the same time when pre-rendering
+        self.prerender_workers = 4
         ########################################################################
 
         ########################################################################
@@ -39,141 +58,396 @@ class TextToSpeech:
         ########################################################################
         # TTS Audio Configuration
         ########################################################################
-        audio_sample_rate = 24000
-        audio_bits_per_sample = 16
-        audio_channels = 1
+        self.audio_sample_rate = 24000
+        self.audio_bits_per_sample = 16
+        self.audio_channels = 1
         ########################################################################
 
-        self.wav_header = self.genWavHeader(audio_sample_rate, audio_bits_per_sample, audio_channels)
+        self.wav_header = self.genWavHeader(self.audio_sample_rate, self.audio_bits_per_sample, self.audio_channels)
 
-        self.ssml_gender = texttospeech.SsmlVoiceGender.MALE
-        self.audio_encoding = texttospeech.AudioEncoding.LINEAR16
+        self.ssml_gender = "MALE"
+        self.audio_encoding = "LINEAR16"
 
-        self.client = texttospeech.TextToSpeechClient()
-        self.voice = texttospeech.VoiceSelectionParams(
-            language_code=self.language_code, ssml_gender=self.ssml_gender
-        )
-        self.audio_config = texttospeech.AudioConfig(
-            audio_encoding=self.audio_encoding, speaking_rate=self.speaking_rate, pitch=self.pitch
-        )
-        self.text_audio_map = self.load_text_audio_seqs()
+        # Name of the backend selected with TTS_BACKEND, the backend itself is created on first use
+        self.backend_name = backend_class().name
+        # Rate limits, prioritizes and retries the calls to the backend
+        self.scheduler = get_scheduler()
+        # Codec sentence audio is stored with (selected with TTS_STORAGE_CODEC)
+        self.storage_codec = get_storage_codec()
+        self.prefetcher = Prefetcher(read_ahead=self.read_ahead)
+        self.cache = get_cache()
 
-    def process(self):
-        print(f"PROCESS_FILE: {self.input_file_path}")
-        self.text_audio_map = []
-        with open(self.input_file_path, "r") as f:
-            lines = f.readlines()
+    @property
+    def backend(self):
+        return get_backend()
+
+    def voice_config(self):
+        return {'backend': self.backend_name,
+                'language_code': self.language_code,
+                'ssml_gender': self.ssml_gender,
+                'speaking_rate': self.speaking_rate,
+                'pitch': self.pitch,
+                'audio_encoding': self.audio_encoding,
+                'sample_rate': self.audio_sample_rate}
+
+    @staticmethod
+    def iter_lines(text_items):
+        # Same lines `readlines()` would return for the concatenated items, without materializing them
+        decoder = io.IncrementalNewlineDecoder(None, translate=True)
+        buf = ""
+        for item in text_items:
+            buf += decoder.decode(item)
+            *lines, buf = buf.split("\n")
             for line in lines:
-                sentences = line.strip().split(". ")
-                for i, l in enumerate(sentences):
-                    if l == "":
-                        continue
-                    if l.endswith("\n"):
-                        l += "\n"
-                    elif i < len(sentences) - 1:
-                        l += ". "
-                    else:
-                        l += "\n"
-                    self.text_audio_map.append((l, None))
-
-        # Save initial text to file, with no audio
-        if os.path.exists(self.output_filepath_seqs):
-            with open(self.output_filepath_seqs, "rb") as f:
-                text_list_audio_loaded = pickle.load(f)
-                if len(text_list_audio_loaded) == len(self.text_audio_map):
-                    self.text_audio_map = text_list_audio_loaded
+                yield line + "\n"
+        buf += decoder.decode("", final=True)
+        if buf:
+            yield buf
+
+    @staticmethod
+    def iter_sentences(lines):
+        for line in lines:
+            start = time.perf_counter()
+            sentences = line.strip().split(". ")
+            split = []
+            for i, l in enumerate(sentences):
+                if l == "":
+                    continue
+                if l.endswith("\n"):
+                    l += "\n"
+                elif i < len(sentences) - 1:
+                    l += ". "
                 else:
-                    print("WARNING: Loaded text list audio is different length "
-                          "than original text list audio")
-                    os.remove(self.output_filepath_seqs)
+                    l += "\n"
+                split.append(l)
+            SENTENCE_SPLIT_SECONDS.observe(time.perf_counter() - start)
+            yield from split
 
-        self.save_text_audio_seqs(overwrite=False)
+    def process(self, text_items=None, callback=None):
+        print(f"PROCESS_FILE: {self.input_file_path}")
+        if text_items is None:
+            f = open(self.input_file_path, "r")
+            lines = f
+        else:
+            f = None
+            lines = self.iter_lines(text_items)
+        try:
+            sentences = self.iter_sentences(lines)
 
-    def stream_index(self, index, callback):
-        if self.text_audio_map is None:
-            print(" => File not processed yet. Please run `process()` first.")
-            return None
-        text, audio = self.text_audio_map[index]
+            # Keep previously synthesized audio for every sentence that is still there
+            if self.store.exists():
+                text_list = list(sentences)
+                self.store.refresh()
+                if text_list == self.store.text_list:
+                    return
+                carry = self.match_sentences(self.store.text_list, text_list)
+                print(f"REPROCESS: {len(carry)} of {len(text_list)} sentences keep their audio")
+                self.store.rebase(text_list, carry)
+                self.fill_from_cache(0, len(text_list), callback)
+                return
+
+            # Sentences become available to the player while later pages are still being parsed
+            self.store.create([])
+            batch = []
+            for sentence in sentences:
+                batch.append(sentence)
+                if len(batch) >= 64:
+                    self.store.append_text(batch)
+                    self.fill_from_cache(len(self.store.text_list) - len(batch), len(self.store.text_list), callback)
+                    batch = []
+            self.store.append_text(batch)
+            self.fill_from_cache(len(self.store.text_list) - len(batch), len(self.store.text_list), callback)
+        finally:
+            if f is not None:
+                f.close()
+
+    def match_sentences(self, old_text_list, new_text_list):
+        # new index -> old index with audio for the same sentence text, which always has the same audio,
+        # so moved and repeated sentences keep their audio too
+        with_audio = {}
+        for j, text in enumerate(old_text_list):
+            if self.store.has(j):
+                with_audio.setdefault(text, j)
+        return {i: with_audio[text] for i, text in enumerate(new_text_list) if text in with_audio}
 
+    def get_audio(self, index):
+        # WAV audio of a stored sentence, decoded from the storage codec
+        audio = self.store.get(index)
         if audio is None:
-            # Remove formatting from text using the formatting array
-            text_clean = callback(text)
-
-            print(f"STREAMING [API]: {text.strip()}")
-            synthesis_input = texttospeech.SynthesisInput(text=text_clean)
-            audio = self.client.synthesize_speech(input=synthesis_input,
-                                                  voice=self.voice,
-                                                  audio_config=self.audio_config).audio_content
-            # Save updated cache to file
-            self.text_audio_map[index] = (text, audio)
-            try:
-                self.save_text_audio_seqs(overwrite=True)
-            except KeyboardInterrupt as e:
-                self.save_text_audio_seqs(overwrite=True)
-                raise KeyboardInterrupt from e
+            return None
+        return decode(audio, self.store.encoding(index), self.audio_sample_rate, self.audio_channels)
+
+    def pcm_length(self, index):
+        # Length of the PCM audio of a stored sentence, None if it has no audio yet
+        length = self.store.pcm_length(index)
+        if length is not None or not self.store.has(index):
+            return length
+        # Stored before the PCM length was recorded
+        if self.store.encoding(index) == self.store.ENCODING_LINEAR16:
+            header = self.store.read(index, 0, 256)
+            return None if header is None else parse_wav(header, total_size=self.store.length(index))[4]
+        audio = self.get_audio(index)
+        return None if audio is None else len(wav_pcm(audio))
+
+    def put_audio(self, index, audio, key=None):
+        # Encodes WAV audio once with the storage codec, for the store and, under `key`, the shared cache,
+        # along with its PCM length (exports size compressed audio from it without decoding)
+        encoding, data = encode(audio, self.storage_codec)
+        pcm_length = parse_wav(audio)[4]
+        if key is not None:
+            self.cache.put(key, data, encoding, pcm_length)
+        self.store.put(index, data, encoding, pcm_length)
 
+    def put_cached(self, index, cached):
+        # Stores an (encoding, data, PCM length) entry of the shared cache as is, it is already encoded
+        encoding, data, pcm_length = cached
+        self.store.put(index, data, encoding, pcm_length)
+
+    def decode_cached(self, cached):
+        return decode(cached[1], cached[0], self.audio_sample_rate, self.audio_channels)
+
+    def stream_index(self, index, callback, priority=INTERACTIVE):
+        return self.stream_audio(index, callback, priority=priority)[0]
+
+    def stream_audio(self, index, callback, accept=None, priority=INTERACTIVE):
+        # Returns (audio, mimetype), the stored compressed audio as is if accept(mimetype) allows it, else WAV
+        # (a missing sentence is synthesized at `priority`, INTERACTIVE when a listener waits on it)
+        if not self.store.exists():
+            print(" => File not processed yet. Please run `process()` first.")
+            return None, None
+        # Pick up sentences and audio written by a processing job since this store was loaded
+        self.store.refresh()
+        stored = self.read_stored(index, accept)
+        if stored is None:
+            AUDIO_LOOKUPS.inc(self.document, "store", "miss")
+            # A listener now waits on it, a read-ahead of it still waiting for its turn goes first
+            self.scheduler.promote((self.document, index), priority)
+            stored = self.prefetcher.fetch(index, lambda i: self.synthesize_index(i, callback, priority)), "audio/x-wav"
         else:
-            print(f"STREAMING [CACHE]: {text.strip()}")
-
-        audio_io = io.BytesIO(audio)
-        return audio_io.read()
-
-    def load_text_audio_seqs(self):
-        print("TEXT-AUDIO-SEQS: Loading ...")
-        if not self.output_filepath_seqs:
-            print("TEXT-AUDIO-SEQS: No cache file found. Please call process_file first.")
-            sys.exit(1)
-        if os.path.isfile(self.output_filepath_seqs):
-            with open(self.output_filepath_seqs, "rb") as f:
-                return pickle.load(f)
-        return None
-
-    def save_text_audio_seqs(self, overwrite=False):
-        print("TEXT-AUDIO-SEQS: Saving ...")
-        if not self.output_filepath_seqs:
-            print("TEXT-AUDIO-SEQS: No cache file found. Please call process_file first.")
-            sys.exit(1)
-        if overwrite or not os.path.exists(self.output_filepath_seqs):
-            with open(self.output_filepath_seqs, "wb") as f:
-                pickle.dump(self.text_audio_map, f)
-            print(
-                f" - Saved text_audio_map (overwrite={overwrite}): `{self.output_filepath_seqs}`")
+            AUDIO_LOOKUPS.inc(self.document, "store", "hit")
+        self.schedule_read_ahead(index, callback)
+
+        audio_io = io.BytesIO(stored[0])
+        return audio_io.read(), stored[1]
+
+    async def stream_audio_async(self, index, callback, accept=None):
+        # `stream_audio()` for the asyncio serving path: file I/O runs in the default thread pool of the event loop
+        # and a missing sentence is synthesized with the non-blocking client of the backend
+        if not await asyncio.to_thread(self.store.exists):
+            print(" => File not processed yet. Please run `process()` first.")
+            return None, None
+        await asyncio.to_thread(self.store.refresh)
+        stored = await asyncio.to_thread(self.read_stored, index, accept)
+        if stored is None:
+            AUDIO_LOOKUPS.inc(self.document, "store", "miss")
+            self.scheduler.promote((self.document, index), INTERACTIVE)
+            audio = await self.prefetcher.fetch_async(index, lambda i: self.synthesize_index_async(i, callback))
+            stored = audio, "audio/x-wav"
+        else:
+            AUDIO_LOOKUPS.inc(self.document, "store", "hit")
+        self.schedule_read_ahead(index, callback)
+        return bytes(stored[0]), stored[1]
+
+    def read_stored(self, index, accept=None):
+        # (audio, mimetype) of a stored sentence, or None if it has no audio yet
+        audio = self.store.get(index)
+        if audio is None:
+            return None
+        encoding = self.store.encoding(index)
+        if encoding != self.store.ENCODING_LINEAR16 and accept is not None and accept(mimetype(encoding)):
+            return audio, mimetype(encoding)
+        return decode(audio, encoding, self.audio_sample_rate, self.audio_channels), "audio/x-wav"
+
+    def schedule_read_ahead(self, index, callback):
+        # Synthesize the next few sentences in the background so playback does not wait on the API
+        upcoming = [i for i in range(index + 1, min(index + 1 + self.read_ahead, len(self.store.text_list)))
+                    if not self.store.has(i) and self.store.text_list[i].strip()]
+        self.prefetcher.schedule(index, upcoming, lambda i: self.synthesize_index(i, callback, READ_AHEAD))
+
+    def synthesize_index(self, index, callback, priority=INTERACTIVE):
+        # Another request may have stored it while this one was waiting
+        audio = self.get_audio(index)
+        if audio is not None:
+            return audio
+        with self.store.synthesis_lock(index):
+            # Or another worker process, while this one waited for the lock
+            self.store.refresh()
+            audio = self.get_audio(index)
+            if audio is not None:
+                return audio
+            return self._synthesize_index(index, callback, priority)
+
+    async def synthesize_index_async(self, index, callback):
+        # `synthesize_index()` for the asyncio serving path
+        audio = await asyncio.to_thread(self.get_audio, index)
+        if audio is not None:
+            return audio
+        lock = self.store.synthesis_lock(index)
+        # Waiting on another process occupies a pool thread rather than the event loop
+        await asyncio.to_thread(lock.__enter__)
+        try:
+            await asyncio.to_thread(self.store.refresh)
+            audio = await asyncio.to_thread(self.get_audio, index)
+            if audio is not None:
+                return audio
+
+            text_clean = callback(self.store.text_list[index])
+            key = self.cache.key(text_clean, self.voice_config())
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is None:
+                AUDIO_LOOKUPS.inc(self.document, "shared", "miss")
+
+                async def synthesize():
+                    with INFLIGHT_SYNTHESES.track(), TTS_API_SECONDS.time(self.backend.name, "single"):
+                        return await self.backend.synthesize_async(text_clean, self.voice_config())
+
+                audio = await self.scheduler.call_async(synthesize, INTERACTIVE, len(text_clean),
+                                                        key=(self.document, index))
+                await asyncio.to_thread(self.put_audio, index, audio, key)
+                return audio
+            AUDIO_LOOKUPS.inc(self.document, "shared", "hit")
+            await asyncio.to_thread(self.put_cached, index, cached)
+            return await asyncio.to_thread(self.decode_cached, cached)
+        finally:
+            await asyncio.to_thread(lock.__exit__, None, None, None)
+
+    def _synthesize_index(self, index, callback, priority):
+        text = self.store.text_list[index]
+        # Remove formatting from text using the formatting array
+        text_clean = callback(text)
+
+        # Same text with the same voice may already have been synthesized for any document
+        key = self.cache.key(text_clean, self.voice_config())
+        cached = self.cache.get(key)
+        if cached is None:
+            AUDIO_LOOKUPS.inc(self.document, "shared", "miss")
+
+            def synthesize():
+                with INFLIGHT_SYNTHESES.track(), TTS_API_SECONDS.time(self.backend.name, "single"):
+                    return self.backend.synthesize(text_clean, self.voice_config())
+
+            # Through the scheduler, within the API quota and ahead of lower priority work
+            audio = self.scheduler.call(synthesize, priority, len(text_clean), key=(self.document, index))
+            # Append the new segment to the audio store, and to the shared cache
+            self.put_audio(index, audio, key)
+            return audio
+        AUDIO_LOOKUPS.inc(self.document, "shared", "hit")
+        self.put_cached(index, cached)
+        return self.decode_cached(cached)
+
+    def missing(self, callback, indices=None):
+        # Sentences with something to say but no audio yet
+        self.store.refresh()
+        if not self.store.exists():
+            return []
+        if indices is None:
+            indices = range(len(self.store.text_list))
+        return [i for i in indices if not self.store.has(i) and callback(self.store.text_list[i]).strip()]
+
+    def prerender(self, callback, indices=None, progress=None):
+        # Synthesize every sentence that has no audio yet
+        self.store.refresh()
+        self.fill_from_cache(0, len(self.store.text_list), callback)
+        missing = self.missing(callback, indices)
+        print(f"PRERENDER: {len(missing)} sentences to synthesize")
+
+        batch_synthesis = self.batch_synthesis and self.backend.supports_marks
+        batches = self.pack_batches(missing, callback) if batch_synthesis else [[i] for i in missing]
+
+        def render(batch):
+            if len(batch) == 1:
+                self.prefetcher.fetch(batch[0], lambda i: self.synthesize_index(i, callback, BULK))
+            else:
+                self.synthesize_batch(batch, callback)
+            return batch
+
+        with ThreadPoolExecutor(max_workers=self.prerender_workers, thread_name_prefix="prerender") as executor:
+            for batch in executor.map(render, batches):
+                if progress is not None:
+                    progress(len(batch))
+
+    def pack_batches(self, indices, callback):
+        batches = []
+        batch, batch_bytes = [], len("<speak></speak>")
+        for i in indices:
+            item_bytes = len(self.ssml_item(i, callback(self.store.text_list[i])).encode())
+            if batch and batch_bytes + item_bytes > self.batch_max_bytes:
+                batches.append(batch)
+                batch, batch_bytes = [], len("<speak></speak>")
+            batch.append(i)
+            batch_bytes += item_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def ssml_item(index, text_clean):
+        return f'<mark name="{index}"/>{escape(text_clean.strip())} '
+
+    def synthesize_batch(self, indices, callback):
+        # One API call for several sentences, cut back into per-sentence segments at the <mark> timepoints
+        texts = {i: callback(self.store.text_list[i]) for i in indices}
+        ssml = "<speak>" + "".join(self.ssml_item(i, texts[i]) for i in indices) + "</speak>"
+
+        def synthesize():
+            with INFLIGHT_SYNTHESES.track(), TTS_API_SECONDS.time(self.backend.name, "batch"):
+                return self.backend.synthesize_marked(ssml, self.voice_config())
+
+        audio, timepoints = self.scheduler.call(synthesize, BULK, len(ssml))
+
+        sample_rate, bits_per_sample, channels, data_offset, data_size = parse_wav(audio)
+        pcm = audio[data_offset:data_offset + data_size]
+        frame_bytes = channels * bits_per_sample // 8
+        starts = {int(name): round(seconds * sample_rate) * frame_bytes for name, seconds in timepoints.items()}
+
+        marked = [i for i in indices if i in starts]
+        voice_config = self.voice_config()
+        for n, i in enumerate(marked):
+            end = starts[marked[n + 1]] if n + 1 < len(marked) else len(pcm)
+            segment = pcm[starts[i]:end]
+            audio = self.genWavHeader(sample_rate, bits_per_sample, channels, datasize=len(segment)) + segment
+            key = self.cache.key(texts[i], voice_config)
+            if not self.store.has(i):
+                self.put_audio(i, audio, key)
+            else:
+                encoding, data = encode(audio, self.storage_codec)
+                self.cache.put(key, data, encoding, len(segment))
+
+        # Sentences whose mark was not reported are synthesized on their own
+        for i in indices:
+            if i not in starts:
+                self.prefetcher.fetch(i, lambda j: self.synthesize_index(j, callback, BULK))
+
+    def fill_from_cache(self, start, stop, callback):
+        # Store audio already in the shared cache for sentences [start, stop)
+        if callback is None:
+            return
+        voice_config = self.voice_config()
+        for i in range(start, stop):
+            if self.store.has(i):
+                continue
+            key = self.cache.key(callback(self.store.text_list[i]), voice_config)
+            if self.cache.contains(key):
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.put_cached(i, cached)
 
     def clean(self):
-        if os.path.exists(self.output_filepath_seqs):
-            os.remove(self.output_filepath_seqs)
+        self.prefetcher.cancel()
+        self.store.clean()
+
+    def close(self):
+        self.prefetcher.cancel()
+        self.store.close()
+
+    def memory_usage(self):
+        return self.store.memory_usage()
 
     def text_list(self):
-        return [i[0] for i in self.text_audio_map] if self.text_audio_map else None
+        return self.store.text_list if self.store.text_list else None
 
     def num_seqs_cached(self):
-        return len([x for x in self.text_audio_map if x[1] is not None]) if self.text_audio_map else None
-
-    def genWavHeader(self, sampleRate, bitsPerSample, channels):
-        datasize = 2000 * 10 ** 6
-        # (4byte) Marks file as RIFF
-        o = bytes("RIFF", 'ascii')
-        # (4byte) File size in bytes excluding this and RIFF marker
-        o += (datasize + 36).to_bytes(4, 'little')
-        # (4byte) File type
-        o += bytes("WAVE", 'ascii')
-        # (4byte) Format Chunk Marker
-        o += bytes("fmt ", 'ascii')
-        # (4byte) Length of above format data
-        o += (16).to_bytes(4, 'little')
-        # (2byte) Format type (1 - PCM)
-        o += (1).to_bytes(2, 'little')
-        # (2byte)
-        o += (channels).to_bytes(2, 'little')
-        # (4byte)
-        o += (sampleRate).to_bytes(4, 'little')
-        o += (sampleRate * channels * bitsPerSample //
-              8).to_bytes(4, 'little')  # (4byte)
-        o += (channels * bitsPerSample // 8).to_bytes(2, 'little')  # (2byte)
-        # (2byte)
-        o += (bitsPerSample).to_bytes(2, 'little')
-        # (4byte) Data Chunk Marker
-        o += bytes("data", 'ascii')
-        # (4byte) Data size in bytes
-        o += (datasize).to_bytes(4, 'little')
-        return o
+        return self.store.num_cached() if self.store.text_list else None
+
+    def genWavHeader(self, sampleRate, bitsPerSample, channels, datasize=2000 * 10 ** 6):
+        return gen_wav_header(sampleRate, bitsPerSample, channels, datasize)
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from flask import Request
+
+
+class HashingFile:
+    # Upload spooled straight to a temporary file in the upload folder, hashed as it is written,
+    # so that it never has to be held in memory or copied again
+
+    def __init__(self, directory):
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix=".upload-", suffix=".tmp", delete=False)
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+
+class UploadRequest(Request):
+    # Request whose uploaded files are written directly into `upload_folder` by the form parser
+    upload_folder = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.upload_folder is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        os.makedirs(self.upload_folder, exist_ok=True)
+        f = HashingFile(self.upload_folder)
+        # Kept so that files of a failed or partially handled request can be removed, see `discard_uploads()`
+        if not hasattr(self, 'upload_files'):
+            self.upload_files = []
+        self.upload_files.append(f)
+        return f
+
+    def discard_uploads(self):
+        for f in getattr(self, 'upload_files', []):
+            f.discard()
+
+
+def store_upload(file_storage, upload_folder):
+    # Moves an upload into `<upload_folder>/<md5>/<filename>` and returns (upload_id, is_duplicate)
+    f = file_storage.stream
+    filename = os.path.basename(file_storage.filename)
+    if isinstance(f, HashingFile):
+        upload_id = f.md5.hexdigest()
+    else:
+        # Stream from another request class, hashed in chunks
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+        f.seek(0)
+        upload_id = md5.hexdigest()
+
+    upload_dir_path = os.path.join(upload_folder, upload_id)
+    if os.path.exists(upload_dir_path):
+        return upload_id, True
+
+    # Assembled in a temporary directory and renamed into place, so a document directory is never incomplete
+    tmp_dir_path = tempfile.mkdtemp(dir=upload_folder, prefix=f".{upload_id}-")
+    try:
+        if isinstance(f, HashingFile):
+            f.file.close()
+            os.replace(f.file.name, os.path.join(tmp_dir_path, filename))
+        else:
+            file_storage.save(os.path.join(tmp_dir_path, filename))
+        try:
+            os.rename(tmp_dir_path, upload_dir_path)
+        except OSError:
+            # The same document was stored by a concurrent upload
+            if not os.path.isdir(upload_dir_path):
+                raise
+            return upload_id, True
+    finally:
+        if os.path.exists(tmp_dir_path):
+            shutil.rmtree(tmp_dir_path)
+    return upload_id, False
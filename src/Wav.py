@@ -0,0 +1,64 @@
+import struct
+
+
+def gen_wav_header(sampleRate, bitsPerSample, channels, datasize=2000 * 10 ** 6):
+    # (4byte) Marks file as RIFF
+    o = bytes("RIFF", 'ascii')
+    # (4byte) File size in bytes excluding this and RIFF marker
+    o += (datasize + 36).to_bytes(4, 'little')
+    # (4byte) File type
+    o += bytes("WAVE", 'ascii')
+    # (4byte) Format Chunk Marker
+    o += bytes("fmt ", 'ascii')
+    # (4byte) Length of above format data
+    o += (16).to_bytes(4, 'little')
+    # (2byte) Format type (1 - PCM)
+    o += (1).to_bytes(2, 'little')
+    # (2byte)
+    o += (channels).to_bytes(2, 'little')
+    # (4byte)
+    o += (sampleRate).to_bytes(4, 'little')
+    o += (sampleRate * channels * bitsPerSample //
+          8).to_bytes(4, 'little')  # (4byte)
+    o += (channels * bitsPerSample // 8).to_bytes(2, 'little')  # (2byte)
+    # (2byte)
+    o += (bitsPerSample).to_bytes(2, 'little')
+    # (4byte) Data Chunk Marker
+    o += bytes("data", 'ascii')
+    # (4byte) Data size in bytes
+    o += (datasize).to_bytes(4, 'little')
+    return o
+
+
+def gen_wav(pcm, sample_rate, bits_per_sample, channels):
+    return gen_wav_header(sample_rate, bits_per_sample, channels, len(pcm)) + pcm
+
+
+def parse_wav(data, total_size=None):
+    # Returns (sample_rate, bits_per_sample, channels, data_offset, data_size) of a RIFF/WAVE blob
+    # (`data` may be just the beginning of the blob, with `total_size` the size of the whole blob)
+    total_size = len(data) if total_size is None else total_size
+    if len(data) < 12 or bytes(data[0:4]) != b"RIFF" or bytes(data[8:12]) != b"WAVE":
+        raise ValueError("Not a RIFF/WAVE file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = bytes(data[pos:pos + 4])
+        chunk_size, = struct.unpack_from("<I", data, pos + 4)
+        if chunk_id == b"fmt ":
+            _, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", data, pos + 8)
+            fmt = (sample_rate, bits_per_sample, channels)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("WAVE data chunk before fmt chunk")
+            # Streamed headers may carry a placeholder size larger than the actual data
+            data_size = min(chunk_size, total_size - pos - 8)
+            return fmt + (pos + 8, data_size)
+        # Chunks are padded to an even size
+        pos += 8 + chunk_size + (chunk_size & 1)
+    raise ValueError("WAVE data chunk not found")
+
+
+def wav_pcm(data):
+    _, _, _, data_offset, data_size = parse_wav(data)
+    return memoryview(data)[data_offset:data_offset + data_size]
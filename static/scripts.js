@@ -10,6 +10,9 @@ const btn_clean = document.getElementById("btn_clean");
 const btn_download_txt = document.getElementById("btn_download_txt");
 btn_download_txt.hidden = data.info.is_processed === false;
 
+const btn_download_audio = document.getElementById("btn_download_audio");
+btn_download_audio.hidden = data.info.is_processed === false;
+
 // ============================================================
 // PlayBack Controls
 const controls_box = document.getElementById("controlsBox");
@@ -31,11 +34,22 @@ const current_text = document.getElementById("currentText")
 // ============================================================
 // Options
 const auto_scroll = document.getElementById("autoScroll")
+// Play one continuous stream instead of loading every sentence separately
+const gapless = document.getElementById("gapless")
 
 // ============================================================
 // Full Text Display
 const textbox = document.getElementById("textbox");
 
+// ============================================================
+// Sentences, fetched in windows as the listener moves through the document
+const num_seqs = data.info.num_seqs || 0;
+const window_size = 200;
+// index -> sentence text
+const text_cache = {};
+// window number -> Promise of the request loading it
+const window_requests = {};
+
 // ============================================================
 // Formatting Classes
 const formatting = [
@@ -46,14 +60,25 @@ const formatting = [
     "CENTER"
 ]
 
+// ============================================================
+// Background Processing Job
+const job_progress = document.getElementById("jobProgress");
+const job_running = Boolean(data.info.job) && ["queued", "running"].includes(data.info.job.status);
+
 // ============================================================
 // Handle disabling and hiding of certain elements
-btn_process.disabled = data.info.is_processed === true;
-btn_clean.disabled = data.info.is_processed === false;
+btn_process.disabled = data.info.is_processed === true || job_running;
+btn_clean.disabled = data.info.is_processed === false || job_running;
 
 // ============================================================
 // Audio Player
 let audio_index = 0
+// Continuous stream currently playing (null when playing sentence by sentence), the sentence it started at
+// and the sentence boundaries received for it so far
+let stream_id = null
+let stream_start = null
+let timeline = []
+let timeline_fetched = 0
 const audio_source = document.getElementById("audio_source");
 audio_source.removeEventListener("loadeddata", () => { });
 
@@ -64,6 +89,36 @@ if (data.info.is_processed === true) {
 // ============================================================
 // ============================================================
 
+function get_status_url() {
+    const parser = new URL(window.location);
+    parser.searchParams.set("action", "status");
+    return parser.href;
+}
+
+function poll_job_status() {
+    fetch(get_status_url())
+        .then(response => response.json())
+        .then(status => {
+            if (status.status === "queued" || status.status === "running") {
+                let text = `Processing... ${status.pages_done}/${status.pages_total || "?"} pages, ${status.blocks_done} blocks`;
+                if (status.eta_seconds !== null) {
+                    text += ` (ETA: ${Math.ceil(status.eta_seconds)}s)`;
+                }
+                job_progress.innerText = text;
+                setTimeout(poll_job_status, 1000);
+            } else {
+                // Reload without the action query param to show the processed document
+                const parser = new URL(window.location);
+                parser.searchParams.delete("action");
+                window.location = parser.href;
+            }
+        });
+}
+
+if (job_running) {
+    poll_job_status();
+}
+
 function process() {
     console.log("Processing...");
     const parser = new URL(window.location);
@@ -95,6 +150,33 @@ function download_txt() {
     window.location = parser.href;
 }
 
+const export_progress = document.getElementById("exportProgress");
+
+function download_audio(format, start = true) {
+    // Missing audio is rendered by a background job first, the export starts once it is done
+    const parser = new URL(window.location);
+    parser.searchParams.set("action", "prepare_export");
+    parser.searchParams.set("start", start ? "1" : "0");
+    fetch(parser.href)
+        .then(response => response.json())
+        .then(status => {
+            if (status.status === "queued" || status.status === "running") {
+                export_progress.innerText = `Rendering audio... ${status.sentences_done}/${status.sentences_total || "?"} sentences`;
+                setTimeout(() => download_audio(format, false), 1000);
+            } else if (status.status === "done") {
+                console.log("Downloading Audio...");
+                export_progress.innerText = "";
+                parser.searchParams.delete("start");
+                parser.searchParams.set("action", "export");
+                parser.searchParams.set("format", format);
+                parser.searchParams.set("markers", "1");
+                window.location = parser.href;
+            } else {
+                export_progress.innerText = `Rendering audio failed: ${status.error || status.status}`;
+            }
+        });
+}
+
 // ============================================================
 // ============================================================
 
@@ -124,6 +206,97 @@ function get_stream_url(index) {
     return parser.href;
 }
 
+function get_continuous_url(index) {
+    const parser = new URL(window.location);
+    parser.searchParams.set("action", "stream_from");
+    parser.searchParams.set("index", index);
+    console.log(`Streaming: ${parser.href}`);
+    return parser.href;
+}
+
+function get_timeline_url() {
+    const parser = new URL(window.location);
+    parser.searchParams.set("action", "timeline");
+    parser.searchParams.set("index", stream_start);
+    return parser.href;
+}
+
+function get_text_url(start, count) {
+    const parser = new URL(window.location);
+    parser.searchParams.set("action", "text");
+    parser.searchParams.set("start", start);
+    parser.searchParams.set("count", count);
+    return parser.href;
+}
+
+function render_window(w, start, text_list) {
+    const container = document.getElementById("window_" + w);
+    const paras = [document.createElement("p")];
+    // Append link elements to the textbox
+    for (let n = 0; n < text_list.length; n++) {
+        const i = start + n;
+        const text = text_list[n];
+        const link = document.createElement("a");
+        link.onclick = function () {
+            seek_to_index(i);
+        };
+        link.id = "text_" + i
+        handle_formatting(link, text)
+        if (i === audio_index) {
+            link.classList.add("ACTIVE")
+        }
+
+        paras[paras.length - 1].appendChild(link);
+
+        if (text[text.length - 1] === "\n") {
+            paras.push(document.createElement("p"));
+        }
+    }
+    for (let i = 0; i < paras.length; i++) {
+        container.appendChild(paras[i]);
+    }
+}
+
+function load_window(w) {
+    if (w < 0 || w * window_size >= num_seqs) {
+        return Promise.resolve();
+    }
+    if (!(w in window_requests)) {
+        window_requests[w] = fetch(get_text_url(w * window_size, window_size))
+            .then(response => response.json())
+            .then(result => {
+                result.text_list.forEach((text, n) => text_cache[result.start + n] = text);
+                render_window(w, result.start, result.text_list);
+            })
+            .catch(error => {
+                // Retried the next time the window is needed
+                delete window_requests[w];
+                throw error;
+            });
+    }
+    return window_requests[w];
+}
+
+function with_text(index, callback) {
+    const w = Math.floor(index / window_size);
+    // Neighbouring windows are loaded ahead so moving past a window boundary does not wait
+    load_window(w - 1);
+    load_window(w + 1);
+    load_window(w).then(() => callback(text_cache[index]));
+}
+
+function update_timeline() {
+    timeline_fetched = Date.now();
+    const current_stream_id = stream_id;
+    fetch(get_timeline_url())
+        .then(response => response.ok ? response.json() : [])
+        .then(result => {
+            if (current_stream_id === stream_id) {
+                timeline = result;
+            }
+        });
+}
+
 function handle_formatting(elem, text) {
     // empty class list
     elem.removeAttribute('class')
@@ -142,10 +315,14 @@ function handle_formatting(elem, text) {
 
 
 function updateProgress() {
-    let text = data.text_list[audio_index]
+    let text = text_cache[audio_index]
+    if (text === undefined) {
+        with_text(audio_index, updateProgress);
+        return;
+    }
 
     console.log(`Setting progress: [${audio_index}] - ${text}`);
-    progress_text.innerText = `${audio_index}/${data.text_list.length - 1}`
+    progress_text.innerText = `${audio_index}/${num_seqs - 1}`
     progress_range.value = audio_index
     handle_formatting(current_text, text)
     const active_text = document.getElementById("text_" + audio_index)
@@ -169,12 +346,20 @@ function updateUI() {
 }
 
 function load_current_index() {
-    audio_source.src = get_stream_url(audio_index)
+    if (gapless.checked) {
+        stream_id = Math.random().toString(36).slice(2);
+        stream_start = audio_index;
+        timeline = [];
+        audio_source.src = get_continuous_url(audio_index);
+    } else {
+        stream_id = null;
+        audio_source.src = get_stream_url(audio_index);
+    }
     audio_source.load();
     updateUI()
 }
 
-function seek_to_index(index, forward) {
+function seek_to_index(index, forward, play) {
     if (forward === undefined) {
         forward = true;
     }
@@ -182,35 +367,41 @@ function seek_to_index(index, forward) {
     index = parseInt(index);
 
     if (index < 0) {
-        index = data.text_list.length - 1;
+        index = num_seqs - 1;
     }
 
-    if (index > data.text_list.length - 1) {
+    if (index > num_seqs - 1) {
         index = 0
     }
 
     console.log(`Attempting to seek to: ${index}`);
-    const text = data.text_list[index]
+    // Keep playing if audio was playing when the seek started, the text may have to be fetched first
+    play = play || !audio_source.paused
+    with_text(index, text => seek_to_loaded_index(index, text, forward, play));
+}
+
+function seek_to_loaded_index(index, text, forward, play) {
     // strip out whitespace and newlines
     const text_stripped = text.replace(/\s/g, "").replace(/\n/g, "")
     // if there is no text, play the next audio
     if (text_stripped.length === 0) {
         if (forward) {
-            seek_to_index(index + 1, forward);
+            seek_to_index(index + 1, forward, play);
         } else {
-            seek_to_index(index - 1, forward);
+            seek_to_index(index - 1, forward, play);
         }
         return;
     }
 
     let curr_active = document.getElementById("text_" + audio_index)
     // remove class from active text
-    curr_active.classList.remove("ACTIVE")
+    if (curr_active) {
+        curr_active.classList.remove("ACTIVE")
+    }
     audio_index = index
     console.log("Seeking to: " + audio_index);
-    let autoplay = !audio_source.paused
     load_current_index();
-    if (autoplay) {
+    if (play) {
         audio_source.play();
     }
 }
@@ -261,8 +452,44 @@ document.body.onkeyup = function (e) {
 }
 
 audio_source.addEventListener('ended', function () {
-    next();
-    audio_source.play();
+    // A continuous stream only ends at the end of the document
+    if (stream_id !== null) {
+        return;
+    }
+    seek_to_index(audio_index + 1, true, true);
+});
+
+audio_source.addEventListener('timeupdate', function () {
+    if (stream_id === null) {
+        return;
+    }
+    if (Date.now() - timeline_fetched > 1000) {
+        update_timeline();
+    }
+    // Highlight the sentence the continuous stream is currently playing
+    let index = audio_index;
+    for (const boundary of timeline) {
+        if (boundary.start > audio_source.currentTime) {
+            break;
+        }
+        index = boundary.index;
+    }
+    if (index !== audio_index) {
+        const curr_active = document.getElementById("text_" + audio_index);
+        if (curr_active) {
+            curr_active.classList.remove("ACTIVE");
+        }
+        audio_index = index;
+        updateProgress();
+    }
+});
+
+gapless.addEventListener('change', function () {
+    let autoplay = !audio_source.paused
+    load_current_index();
+    if (autoplay) {
+        audio_source.play();
+    }
 });
 
 // playback_rate.addEventListener('change', function () {
@@ -293,31 +520,19 @@ rateDefault.addEventListener('click', function () {
 // ============================================================
 // ============================================================
 
-if (data.text_list && data.text_list.length > 0) {
-    progress_range.max = data.text_list.length - 1;
-    const paras = [document.createElement("p")];
-    // Append link elements to the textbox
-    for (let i = 0; i < data.text_list.length; i++) {
-        const text = data.text_list[i];
-        const link = document.createElement("a");
-        link.onclick = function () {
-            seek_to_index(i);
-        };
-        link.id = "text_" + i
-        handle_formatting(link, text)
-
-        paras[paras.length - 1].appendChild(link);
-
-        if (text[text.length - 1] === "\n") {
-            paras.push(document.createElement("p"));
-        }
-    }
-    for (let i = 0; i < paras.length; i++) {
-        textbox.appendChild(paras[i]);
+if (num_seqs > 0) {
+    progress_range.max = num_seqs - 1;
+    // One placeholder per window, filled in when the window is loaded
+    for (let w = 0; w * window_size < num_seqs; w++) {
+        const container = document.createElement("div");
+        container.id = "window_" + w;
+        container.style.margin = "0";
+        textbox.appendChild(container);
     }
+    with_text(audio_index, updateUI);
 }
 
-updateUI();
+updatePlaybackRate();
 
 
 // TODO: Show TOC from data.info.toc
\ No newline at end of file